@@ -1,16 +1,28 @@
 import os
 import shutil
 import pathlib
-import zipfile
+import io
 import json
-from flask import Flask, jsonify, render_template, redirect, url_for, request
+import time
+import gzip
+import hashlib
+import math
+import uuid
+import threading
+import importlib.util
+import ingestion
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from collections import OrderedDict
+from contextlib import contextmanager
+from flask import Flask, jsonify, render_template, redirect, url_for, request, g, has_request_context
 from werkzeug.utils import secure_filename
+import click
 import logging
 import logging.config
 import sqlite3
-import folium
-import pandas as pd
-import geopandas as gpd
+from ingestion import LazyModule, simplification_zooms, simplification_level, storage_extensions, open_shapefile_zip, open_shapefiles_zip, write_shapefile_zip, read_shapefile_schema, shapefile_size, file_metadata, read_layer, convert_layer, init_worker, run_task, ingest_outline, ingest_subdiv
 
 
 
@@ -39,6 +51,7 @@ logging_config = {
             'filename': 'logs/error_log.log',
             'maxBytes': 5*1024*1024,
             'backupCount': 5,
+            'delay': True,
         },
         'file_handler_debug': {
             'class': 'logging.handlers.RotatingFileHandler',
@@ -47,6 +60,7 @@ logging_config = {
             'filename': 'logs/debug_log.log',
             'maxBytes': 5*1024*1024,
             'backupCount': 5,
+            'delay': True,
         },
         'console_handler': {
             'class': 'logging.StreamHandler',
@@ -63,19 +77,91 @@ logging.config.dictConfig(logging_config)
 logger = logging.getLogger(__name__)
 logger.debug('Logging is configured.')
 
+# Heavy modules, imported with the first request that needs them
+folium = LazyModule('folium')
+branca = LazyModule('branca')
+brotli = LazyModule('brotli')
+np = LazyModule('numpy')
+shapely = LazyModule('shapely')
+gpd = LazyModule('geopandas')
+
 
 # Global variables
 studies = {}
+studies_loaded = False # the studies are loaded with the first request
+studies_load_lock = threading.Lock()
+studies_lock = threading.RLock() # held while the studies are changed or reloaded
+studies_db_version = None # version of the registry in the database the studies are up to date with
 file_types = ['subdiv']
 
+# Storage format of the new layers: gpkg, or parquet for GeoParquet files which needs pyarrow
+storage_format = os.environ.get('DASHBOARD_STORAGE', 'gpkg')
+if storage_format not in storage_extensions or (storage_format == 'parquet' and importlib.util.find_spec('pyarrow') is None):
+    logger.error(f'The storage format {storage_format} is not available, the layers are stored as geopackages.')
+    storage_format = 'gpkg'
+
+# Uploads staged between the pre-process and the process of a file
+staged_files = OrderedDict()
+staged_files_lock = threading.Lock()
+staging_ttl = 30 * 60 # seconds
+staging_max_size = 2 * 1024**3 # bytes
+
+# Rendered maps, by study and version of the source data
+rendered_maps = OrderedDict()
+rendered_maps_lock = threading.Lock()
+rendered_maps_max_size = 256 * 1024**2 # bytes
+studies_version = 0 # incremented each time the studies are changed
+
+# Spatial indexes of the subdivisions, by file and version of the file
+spatial_indexes = OrderedDict()
+spatial_indexes_lock = threading.Lock()
+spatial_indexes_max_count = 16
+
+# Jobs of ingestion, run by a pool of processes
+jobs = OrderedDict()
+jobs_lock = threading.Lock()
+jobs_pool = None # started with the first job
+jobs_progress = None
+jobs_max_workers = max(1, min(4, (os.cpu_count() or 1) - 1))
+jobs_reprojection_threads = max(1, (os.cpu_count() or 1) // jobs_max_workers) # by worker, so that the workers together use the cores
+jobs_max_pending = 32 # queued or running
+jobs_ttl = 60 * 60 # seconds a finished job is kept
+jobs_dir = os.path.join('data', 'temp', 'jobs')
+ingestion_batch_size = 50000 # features, the big shapefiles are ingested in batches so that the memory of the workers stays bounded
+ingestion_batch_min_size = 256 * 1024**2 # bytes of the extracted shapefile, the smaller ones are read at once
 
-# Connect to the studies database
-try:
-    os.makedirs('data', exist_ok=True)
-    studies_db_path = os.path.join('data', 'studies.db')
-    con = sqlite3.connect(studies_db_path)
-    cursor = con.cursor()
-    cursor.execute('''
+# Clusters of the studies on the map of the studies manager, on a grid for each zoom
+study_clusters = {} # zoom -> cell -> cluster
+study_clusters_layers = {} # zoom -> serialized markers of the clusters
+clustered_studies = {} # study -> point in the clusters
+study_clusters_lock = threading.Lock()
+study_clusters_built = False # the clusters are built with the first map of the studies manager
+cluster_max_zoom = 16 # the studies at the same place are still grouped above
+cluster_cell_size = 64 # pixels
+
+# Metrics of the requests by endpoint, exposed on /metrics, each process of the server keeps its own
+metrics = {} # endpoint -> latencies by bucket, sum and count, count by code, time by stage, payload bytes and features
+metrics_lock = threading.Lock()
+metrics_buckets = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10] # seconds
+slow_request_time = float(os.environ['DASHBOARD_SLOW_REQUEST']) if os.environ.get('DASHBOARD_SLOW_REQUEST') else None # seconds, the slower requests are logged with their stages
+
+# Validators and compression of the responses, the compressed responses with an ETag are kept with the rendered maps
+etag_seed = hashlib.sha1(pathlib.Path(__file__).read_bytes() + pathlib.Path(ingestion.__file__).read_bytes()).hexdigest() # the ETags change with the code
+compression_encodings = (['br'] if importlib.util.find_spec('brotli') is not None else []) + ['gzip'] # by preference
+compression_levels = {'br': 4, 'gzip': 6} # for the responses with an ETag, compressed once
+compression_fast_levels = {'br': 1, 'gzip': 1} # for the others, compressed with each request
+compression_min_size = 1024 # bytes
+compression_mimetypes = ['application/json', 'text/html', 'text/plain', 'application/javascript', 'text/css']
+
+
+# Connections to the databases, kept open by each thread
+db_local = threading.local()
+db_generations = {} # incremented when a database is deleted, the connections of every thread are then closed
+db_generations_lock = threading.Lock()
+db_initialized = set() # databases and generations with their schema, applied once by process
+db_initialized_lock = threading.Lock()
+db_schemas = {
+    'studies.db': '''
         CREATE TABLE IF NOT EXISTS studies (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             name TEXT,
@@ -84,82 +170,1481 @@ try:
             lon FLOAT,
             dir_path TEXT,
             visibility BOOL
+        );
+        CREATE INDEX IF NOT EXISTS studies_name ON studies (name COLLATE NOCASE);
+        CREATE INDEX IF NOT EXISTS studies_location ON studies (lat, lon);
+        CREATE INDEX IF NOT EXISTS studies_visibility ON studies (visibility);
+        CREATE TABLE IF NOT EXISTS registry (
+            version INTEGER
+        );
+        INSERT INTO registry (version) SELECT 0 WHERE NOT EXISTS (SELECT * FROM registry);
+        CREATE TRIGGER IF NOT EXISTS registry_insert AFTER INSERT ON studies BEGIN
+            UPDATE registry SET version = version + 1;
+        END;
+        CREATE TRIGGER IF NOT EXISTS registry_update AFTER UPDATE ON studies BEGIN
+            UPDATE registry SET version = version + 1;
+        END;
+        CREATE TRIGGER IF NOT EXISTS registry_delete AFTER DELETE ON studies BEGIN
+            UPDATE registry SET version = version + 1;
+        END;
+        CREATE VIRTUAL TABLE IF NOT EXISTS studies_search USING fts5 (
+            name,
+            desc,
+            content = 'studies',
+            content_rowid = 'id',
+            tokenize = 'unicode61 remove_diacritics 2'
+        );
+        CREATE TRIGGER IF NOT EXISTS studies_search_insert AFTER INSERT ON studies BEGIN
+            INSERT INTO studies_search (rowid, name, desc) VALUES (new.id, new.name, new.desc);
+        END;
+        CREATE TRIGGER IF NOT EXISTS studies_search_delete AFTER DELETE ON studies BEGIN
+            INSERT INTO studies_search (studies_search, rowid, name, desc) VALUES ('delete', old.id, old.name, old.desc);
+        END;
+        CREATE TRIGGER IF NOT EXISTS studies_search_update AFTER UPDATE OF name, desc ON studies BEGIN
+            INSERT INTO studies_search (studies_search, rowid, name, desc) VALUES ('delete', old.id, old.name, old.desc);
+            INSERT INTO studies_search (rowid, name, desc) VALUES (new.id, new.name, new.desc);
+        END;
+        CREATE TABLE IF NOT EXISTS catalog (
+            study_id INTEGER,
+            type TEXT,
+            file_id INTEGER,
+            name TEXT,
+            file_path TEXT,
+            features INTEGER,
+            clean INTEGER,
+            unclean INTEGER,
+            minx FLOAT,
+            miny FLOAT,
+            maxx FLOAT,
+            maxy FLOAT,
+            crs TEXT,
+            vertices INTEGER,
+            size INTEGER,
+            PRIMARY KEY (study_id, type, file_id)
+        );
+        CREATE INDEX IF NOT EXISTS catalog_type ON catalog (type);
+        CREATE TABLE IF NOT EXISTS catalog_registry (
+            version INTEGER
+        );
+        INSERT INTO catalog_registry (version) SELECT 0 WHERE NOT EXISTS (SELECT * FROM catalog_registry);
+        CREATE TRIGGER IF NOT EXISTS catalog_registry_insert AFTER INSERT ON catalog BEGIN
+            UPDATE catalog_registry SET version = version + 1;
+        END;
+        CREATE TRIGGER IF NOT EXISTS catalog_registry_update AFTER UPDATE ON catalog BEGIN
+            UPDATE catalog_registry SET version = version + 1;
+        END;
+        CREATE TRIGGER IF NOT EXISTS catalog_registry_delete AFTER DELETE ON catalog BEGIN
+            UPDATE catalog_registry SET version = version + 1;
+        END;
+        CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY,
+            pid INTEGER,
+            finished FLOAT,
+            job TEXT
+        );
+        CREATE INDEX IF NOT EXISTS jobs_finished ON jobs (finished);
+    ''',
+    'files.db': '''
+        CREATE TABLE IF NOT EXISTS subdiv (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT,
+            file_path TEXT
         )
-    ''')
-    con.commit() 
-    logger.info('Connection to the history database established.')
-    
-except Exception as e:
-    logger.error(f'An error has occured while trying to connect to the database: {e}.')
-
-# Get the data form the database
-try:
-    for row in cursor.execute('SELECT * FROM studies'):
-        studies[row[0]] = {}
-        studies[row[0]]['name'] = row[1]
-        studies[row[0]]['desc'] = row[2]
-        studies[row[0]]['lat'] = row[3]
-        studies[row[0]]['lon'] = row[4]
-        studies[row[0]]['dir_path'] = row[5]
-        studies[row[0]]['visibility'] = (row[6] == 1)
-    con.close()
-    logger.info('Studies data retrieved succesfuly from the database.')
-except Exception as e:
-    logger.error(f'An error has occured while retrieving the studies data: {e}.')
-
- 
+    '''
+}
+
+
+# Get the connection of the thread to a database, it is opened and its tables are created the first time
+def get_connection(db_path):
+    connections = db_local.__dict__.setdefault('connections', {})
+    
+    # Close the connections to the databases deleted since
+    for path in [path for path, (_, generation) in connections.items() if generation != db_generations.get(path, 0)]:
+        connections.pop(path)[0].close()
+    
+    if db_path not in connections:
+        # Autocommit, the transactions are explicit, and the statements are cached by the connection
+        con = sqlite3.connect(db_path, timeout=30, isolation_level=None, cached_statements=256)
+        con.execute('PRAGMA journal_mode = WAL')
+        con.execute('PRAGMA synchronous = NORMAL')
+        con.execute('PRAGMA temp_store = MEMORY')
+        con.execute('PRAGMA cache_size = -16000')
+        generation = db_generations.get(db_path, 0)
+        if os.path.basename(db_path) in db_schemas and (db_path, generation) not in db_initialized:
+            with db_initialized_lock:
+                if (db_path, generation) not in db_initialized:
+                    con.executescript(db_schemas[os.path.basename(db_path)])
+                    db_initialized.add((db_path, generation))
+        connections[db_path] = (con, generation)
+    return connections[db_path][0]
+
+
+# Close the connections of every thread to a database before deleting it
+def close_connections(db_path):
+    with db_generations_lock:
+        db_generations[db_path] = db_generations.get(db_path, 0) + 1
+    connections = db_local.__dict__.setdefault('connections', {})
+    if db_path in connections:
+        connections.pop(db_path)[0].close()
+
+
+# Run statements in a single transaction, written at once or not at all
+@contextmanager
+def transaction(con):
+    con.execute('BEGIN IMMEDIATE')
+    try:
+        yield con
+    except Exception:
+        con.execute('ROLLBACK')
+        raise
+    con.execute('COMMIT')
+
+
+# Version of the registry of the studies, incremented by each change of the studies
+def registry_version(con):
+    return con.execute('SELECT version FROM registry').fetchone()[0]
+
+
+# Read the studies, with the version of the registry they are at
+def read_studies(con):
+    new_studies = {}
+    con.execute('BEGIN')
+    try:
+        version = registry_version(con)
+        for row in con.execute('SELECT * FROM studies'):
+            new_studies[row[0]] = {}
+            new_studies[row[0]]['name'] = row[1]
+            new_studies[row[0]]['desc'] = row[2]
+            new_studies[row[0]]['lat'] = row[3]
+            new_studies[row[0]]['lon'] = row[4]
+            new_studies[row[0]]['dir_path'] = row[5]
+            new_studies[row[0]]['visibility'] = (row[6] == 1)
+    finally:
+        con.execute('COMMIT')
+    return version, new_studies
+
+
+# Reload the studies when another process changed them. The data version of the connection only changes when
+# the database is written by another connection, the version of the registry is then read to know if the studies changed.
+def sync_studies():
+    global studies, studies_db_version
+    con = get_connection(os.path.join('data', 'studies.db'))
+    data_version = con.execute('PRAGMA data_version').fetchone()[0]
+    if getattr(db_local, 'studies_data_version', None) == (id(con), data_version) and studies_db_version is not None:
+        return
+    db_local.studies_data_version = (id(con), data_version)
+    if registry_version(con) == studies_db_version:
+        return
+    
+    with studies_lock:
+        version, new_studies = read_studies(con)
+        studies = new_studies
+        studies_db_version = version
+        reset_study_clusters()
+        clear_rendered_maps()
+    logger.info(f'Studies reloaded at the version {version} of the registry.')
+
+
+# Change the studies in a transaction, the studies of the process are changed within it. They stay up to date when
+# no other process changed them since they were loaded, otherwise they are reloaded by the next request.
+@contextmanager
+def studies_transaction():
+    global studies_db_version
+    con = get_connection(os.path.join('data', 'studies.db'))
+    with studies_lock:
+        try:
+            with transaction(con):
+                version = registry_version(con)
+                yield con
+                new_version = registry_version(con)
+        except Exception:
+            studies_db_version = None
+            raise
+        studies_db_version = new_version if version == studies_db_version else None
+
+
+# Register a file with its metadata in the catalog
+def catalog_file(con, studyID, type, fileID, name, file_path, metadata):
+    con.execute('''
+        INSERT OR REPLACE INTO catalog (
+            study_id,
+            type,
+            file_id,
+            name,
+            file_path,
+            features,
+            clean,
+            unclean,
+            minx,
+            miny,
+            maxx,
+            maxy,
+            crs,
+            vertices,
+            size
+        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', (
+        studyID,
+        type,
+        fileID,
+        name,
+        file_path,
+        metadata['features'],
+        metadata['clean'],
+        metadata['unclean'],
+        metadata['minx'],
+        metadata['miny'],
+        metadata['maxx'],
+        metadata['maxy'],
+        metadata['crs'],
+        metadata['vertices'],
+        metadata['size']
+    ))
+
+
+# Cell of the grid of a zoom containing a point, the cells are squares of the web mercator projection
+def cluster_cell(lat, lon, zoom):
+    cells = 256 * 2**zoom // cluster_cell_size
+    lat = min(max(lat, -85.0511), 85.0511)
+    x = (lon + 180) / 360
+    y = (1 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2
+    return (min(max(int(x * cells), 0), cells - 1), min(max(int(y * cells), 0), cells - 1))
+
+
+# Point of a study in the clusters, None when its location is not valid
+def study_point(studyID):
+    try:
+        point = (float(studies[studyID]['lat']), float(studies[studyID]['lon']))
+    except (TypeError, ValueError):
+        return None
+    return point if all(math.isfinite(value) for value in point) else None
+
+
+# Add a study to the clusters, or move it when it is already in them
+def cluster_study(studyID):
+    point = study_point(studyID)
+    with study_clusters_lock:
+        if not study_clusters_built:
+            return
+        if studyID in clustered_studies:
+            uncluster_study(studyID)
+        if point is not None:
+            add_to_clusters(studyID, point)
+
+
+# Add a study at a point to the clusters, the lock must be held
+def add_to_clusters(studyID, point):
+    global study_clusters, study_clusters_layers, clustered_studies
+    for zoom in range(cluster_max_zoom + 1):
+        cell = cluster_cell(*point, zoom)
+        cluster = study_clusters.setdefault(zoom, {}).setdefault(cell, {'studies': set(), 'lat': 0.0, 'lon': 0.0})
+        cluster['studies'].add(studyID)
+        cluster['lat'] += point[0]
+        cluster['lon'] += point[1]
+        study_clusters_layers.pop(zoom, None)
+    clustered_studies[studyID] = point
+
+
+# Build the clusters of all the studies, once
+def build_study_clusters():
+    global study_clusters_built
+    with study_clusters_lock:
+        if study_clusters_built:
+            return
+        for studyID in list(studies):
+            point = study_point(studyID)
+            if point is not None:
+                add_to_clusters(studyID, point)
+        study_clusters_built = True
+
+
+# Remove a study from the clusters, the lock must be held
+def uncluster_study(studyID):
+    global study_clusters, study_clusters_layers, clustered_studies
+    point = clustered_studies.pop(studyID, None)
+    if point is None:
+        return
+    for zoom in range(cluster_max_zoom + 1):
+        cell = cluster_cell(*point, zoom)
+        cluster = study_clusters[zoom][cell]
+        cluster['studies'].discard(studyID)
+        cluster['lat'] -= point[0]
+        cluster['lon'] -= point[1]
+        if len(cluster['studies']) == 0:
+            study_clusters[zoom].pop(cell)
+        study_clusters_layers.pop(zoom, None)
+
+
+# Remove all the clusters, they are built again with the next map of the studies manager
+def reset_study_clusters():
+    global study_clusters, study_clusters_layers, clustered_studies, study_clusters_built
+    with study_clusters_lock:
+        study_clusters = {}
+        study_clusters_layers = {}
+        clustered_studies = {}
+        study_clusters_built = False
+
+
+# Markers of the clusters of a zoom within a bounding box [south, west, north, east], as a JSON list of
+# [lat, lon, number of studies, study ID (when it is alone), tooltip]. The markers are serialized once for each zoom.
+def clusters_data(zoom, bbox=None):
+    zoom = min(max(int(zoom), 0), cluster_max_zoom)
+    build_study_clusters()
+    with study_clusters_lock:
+        layer = study_clusters_layers.get(zoom)
+        if layer is None:
+            points = []
+            markers = []
+            for cluster in study_clusters.get(zoom, {}).values():
+                count = len(cluster['studies'])
+                lat = cluster['lat'] / count
+                lon = cluster['lon'] / count
+                names = sorted(str(studies[studyID]['name']) for studyID in cluster['studies'])
+                if count == 1:
+                    tooltip = names[0]
+                elif zoom == cluster_max_zoom:
+                    tooltip = '<br>'.join(names[:10] + (['...'] if count > 10 else []))
+                else:
+                    tooltip = f'{count} studies'
+                points.append((lat, lon))
+                markers.append(json.dumps([lat, lon, count, next(iter(cluster['studies'])) if count == 1 else None, tooltip], separators=(',', ':')))
+            layer = {'points': np.array(points, dtype=float).reshape(-1, 2), 'markers': markers}
+            study_clusters_layers[zoom] = layer
+    
+    # Keep the markers within the bounding box
+    if bbox is None:
+        kept = range(len(layer['markers']))
+    else:
+        south, west, north, east = bbox
+        lats, lons = layer['points'][:, 0], layer['points'][:, 1]
+        kept = np.flatnonzero((lats >= south) & (lats <= north) & (lons >= west) & (lons <= east))
+    return ('[' + ','.join(layer['markers'][i] for i in kept) + ']').replace('</', '<\\/')
+
+
+# Load the studies from the database, once, with the migrations of the database
+def load_studies():
+    global studies, studies_loaded, studies_db_version
+    with studies_load_lock:
+        if studies_loaded:
+            return
+        
+        # Connect to the studies database
+        try:
+            os.makedirs('data', exist_ok=True)
+            studies_db_path = os.path.join('data', 'studies.db')
+            con = get_connection(studies_db_path)
+            logger.info('Connection to the history database established.')
+    
+        except Exception as e:
+            logger.error(f'An error has occured while trying to connect to the database: {e}.')
+
+        # Get the data form the database
+        try:
+            with studies_lock:
+                studies_db_version, studies = read_studies(con)
+            logger.info('Studies data retrieved succesfuly from the database.')
+        except Exception as e:
+            logger.error(f'An error has occured while retrieving the studies data: {e}.')
+
+        # Put in the catalog the files added before it existed, once
+        try:
+            if con.execute('PRAGMA user_version').fetchone()[0] < 1:
+                for studyID in studies:
+                    study_db_path = os.path.join(studies[studyID]['dir_path'], 'files.db')
+                    if not os.path.exists(study_db_path):
+                        continue
+                    for type in file_types:
+                        for fileID, file_name, file_path in get_connection(study_db_path).execute(f'SELECT id, name, file_path FROM {type}').fetchall():
+                            try:
+                                data = read_layer(file_path)
+                                catalog_file(con, studyID, type, fileID, file_name, file_path, file_metadata(data, file_path))
+                            except Exception as e:
+                                logger.error(f'The file {file_path} could not be put in the catalog: {e}.')
+                con.execute('PRAGMA user_version = 1')
+                logger.info('Catalog of the files filled.')
+        except Exception as e:
+            logger.error(f'An error has occured while filling the catalog of the files: {e}.')
+
+        # Put in the search index the studies added before it existed, once
+        try:
+            if con.execute('PRAGMA user_version').fetchone()[0] < 2:
+                con.execute("INSERT INTO studies_search (studies_search) VALUES ('rebuild')")
+                con.execute('PRAGMA user_version = 2')
+                logger.info('Search index of the studies built.')
+        except Exception as e:
+            logger.error(f'An error has occured while building the search index of the studies: {e}.')
+        
+        # Remove the staged files left by the processes that stopped
+        try:
+            with staged_files_lock:
+                sweep_staged_files()
+        except Exception as e:
+            logger.error(f'An error has occured while removing the staged files: {e}.')
+        
+        studies_loaded = True
+
+
 # Set up the app
 app = Flask('Data Dashboard')
 
 
+# The studies are loaded before the first request, and reloaded when another process changed them
+@app.before_request
+def before_request():
+    g.start = time.perf_counter()
+    g.stages = {}
+    g.features = 0
+    if not studies_loaded:
+        with stage_timer('load'):
+            load_studies()
+    with stage_timer('sync'):
+        sync_studies()
+
+
+# Compress the response and record the metrics of the request
+@app.after_request
+def after_request(response):
+    with stage_timer('compress'):
+        response = compress_response(response)
+    if 'start' in g:
+        payload = 0 if response.is_streamed else response.calculate_content_length() or 0
+        record_request(request.endpoint or 'none', response.status_code, time.perf_counter() - g.start, g.stages, payload, g.features)
+    return response
+
+
+# Load the studies and import the heavy modules in the background, so that the first requests do not wait for them.
+# It can be called by the server once a worker is started, or with the DASHBOARD_WARM_UP environment variable.
+def warm_up():
+    def run():
+        start = time.perf_counter()
+        try:
+            load_studies()
+            for module in [np, shapely, gpd, folium, branca]:
+                module.load()
+            build_study_clusters()
+            logger.info(f'Warm up done in {time.perf_counter() - start:.3f}s.')
+        except Exception as e:
+            logger.error(f'An error has occured during the warm up: {e}.')
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
+
+
+if os.environ.get('DASHBOARD_WARM_UP'):
+    warm_up()
+
+
+
+#####
+# Metrics
+#####
+
+# Time a stage of the request, the times of the stages of the same name are added
+@contextmanager
+def stage_timer(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if has_request_context() and 'stages' in g:
+            g.stages[name] = g.stages.get(name, 0) + time.perf_counter() - start
+
+
+# Count the features sent by the request
+def count_features(count):
+    if has_request_context() and 'features' in g:
+        g.features += count
+
+
+# Add a request or a job to the metrics of its endpoint
+def add_metrics(endpoint, code, duration, stages, payload=0, features=0):
+    with metrics_lock:
+        if endpoint not in metrics:
+            metrics[endpoint] = {'buckets': [0] * len(metrics_buckets), 'sum': 0, 'count': 0, 'codes': {}, 'stages': {}, 'bytes': 0, 'features': 0}
+        endpoint_data = metrics[endpoint]
+        for i, bucket in enumerate(metrics_buckets):
+            if duration <= bucket:
+                endpoint_data['buckets'][i] += 1
+        endpoint_data['sum'] += duration
+        endpoint_data['count'] += 1
+        endpoint_data['codes'][code] = endpoint_data['codes'].get(code, 0) + 1
+        for stage, stage_duration in stages.items():
+            stage_data = endpoint_data['stages'].setdefault(stage, [0, 0])
+            stage_data[0] += stage_duration
+            stage_data[1] += 1
+        endpoint_data['bytes'] += payload
+        endpoint_data['features'] += features
+
+
+# Add a request to the metrics, it is logged with its stages when it is slow
+def record_request(endpoint, code, duration, stages, payload, features):
+    add_metrics(endpoint, code, duration, stages, payload, features)
+    if slow_request_time is not None and duration >= slow_request_time:
+        other = duration - sum(stages.values())
+        logger.warning(
+            f'Slow request {request.method} {request.path} in {duration:.3f}s: '
+            + ''.join(f'{stage} {stage_duration:.3f}s, ' for stage, stage_duration in stages.items())
+            + f'other {other:.3f}s, {payload} bytes, {features} features.'
+        )
+
+
+# Add a finished job to the metrics, as the endpoint job_<type> with its state as code
+def record_job(job):
+    add_metrics(f'job_{job["type"]}', job['state'], job['finished'] - job['time'], job['timings'])
+
+
+# Metrics in the Prometheus text format
+def metrics_text():
+    lines = []
+    with metrics_lock:
+        lines += ['# HELP dashboard_request_duration_seconds Time to respond to the requests, and to run the jobs.', '# TYPE dashboard_request_duration_seconds histogram']
+        for endpoint, endpoint_data in metrics.items():
+            for bucket, count in zip(metrics_buckets, endpoint_data['buckets']):
+                lines.append(f'dashboard_request_duration_seconds_bucket{{endpoint="{endpoint}",le="{bucket}"}} {count}')
+            lines.append(f'dashboard_request_duration_seconds_bucket{{endpoint="{endpoint}",le="+Inf"}} {endpoint_data["count"]}')
+            lines.append(f'dashboard_request_duration_seconds_sum{{endpoint="{endpoint}"}} {endpoint_data["sum"]}')
+            lines.append(f'dashboard_request_duration_seconds_count{{endpoint="{endpoint}"}} {endpoint_data["count"]}')
+        
+        lines += ['# HELP dashboard_requests_total Requests by status code, and jobs by state.', '# TYPE dashboard_requests_total counter']
+        for endpoint, endpoint_data in metrics.items():
+            for code, count in endpoint_data['codes'].items():
+                lines.append(f'dashboard_requests_total{{endpoint="{endpoint}",code="{code}"}} {count}')
+        
+        lines += ['# HELP dashboard_stage_seconds_total Time spent in each stage of the requests.', '# TYPE dashboard_stage_seconds_total counter']
+        for endpoint, endpoint_data in metrics.items():
+            for stage, (stage_duration, count) in endpoint_data['stages'].items():
+                lines.append(f'dashboard_stage_seconds_total{{endpoint="{endpoint}",stage="{stage}"}} {stage_duration}')
+        lines += ['# HELP dashboard_stage_calls_total Requests that went through each stage.', '# TYPE dashboard_stage_calls_total counter']
+        for endpoint, endpoint_data in metrics.items():
+            for stage, (stage_duration, count) in endpoint_data['stages'].items():
+                lines.append(f'dashboard_stage_calls_total{{endpoint="{endpoint}",stage="{stage}"}} {count}')
+        
+        lines += ['# HELP dashboard_response_bytes_total Size of the responses.', '# TYPE dashboard_response_bytes_total counter']
+        for endpoint, endpoint_data in metrics.items():
+            lines.append(f'dashboard_response_bytes_total{{endpoint="{endpoint}"}} {endpoint_data["bytes"]}')
+        lines += ['# HELP dashboard_response_features_total Features rendered in the responses.', '# TYPE dashboard_response_features_total counter']
+        for endpoint, endpoint_data in metrics.items():
+            lines.append(f'dashboard_response_features_total{{endpoint="{endpoint}"}} {endpoint_data["features"]}')
+    return '\n'.join(lines) + '\n'
+
+
+
+#####
+# Validators and compression
+#####
+
+# Strong ETag of a response from the version of its data and its parameters
+def response_etag(key):
+    return hashlib.sha1(repr((etag_seed, key)).encode()).hexdigest()
+
+
+# Response telling the client that its copy of the response with the ETag is still valid, None if it has none.
+# The compressed copies have the encoding appended to the ETag, only the copy in the encoding negotiated for
+# the request is valid, since the not modified response is sent with this encoding.
+def not_modified(etag):
+    if etag is None or request.method not in ['GET', 'HEAD']:
+        return None
+    encoding = response_encoding()
+    if not request.if_none_match.contains_weak(etag if encoding is None else f'{etag}-{encoding}'):
+        return None
+    response = app.response_class(status=304)
+    response.set_etag(etag)
+    return response
+
+
+# Give the ETag to a response, it can then be kept by the browsers and the proxies which ask if it is still valid
+def etag_response(response, etag):
+    if etag is not None:
+        response.set_etag(etag)
+        response.cache_control.no_cache = True
+    return response
+
+
+# Encoding of the response accepted by the client, None if it accepts none
+def response_encoding():
+    for encoding in compression_encodings:
+        if request.accept_encodings.quality(encoding) > 0:
+            return encoding
+    return None
+
+
+# Compress a response with the encoding accepted by the client, when it is big enough or has an ETag. The compressed
+# responses with an ETag are cached, and not modified responses get the ETag of their compressed copy.
+def compress_response(response):
+    etag = response.get_etag()[0]
+    if response.status_code not in [200, 304] or response.direct_passthrough or response.is_streamed or 'Content-Encoding' in response.headers:
+        return response
+    if response.status_code == 200 and response.mimetype not in compression_mimetypes:
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = response_encoding()
+    if encoding is None or (etag is None and (response.status_code == 304 or response.calculate_content_length() < compression_min_size)):
+        return response
+    
+    if response.status_code == 200:
+        key = ('compressed', etag, encoding)
+        data = get_rendered_map(key) if etag is not None else None
+        if data is None:
+            level = compression_levels[encoding] if etag is not None else compression_fast_levels[encoding]
+            if encoding == 'br':
+                data = brotli.compress(response.get_data(), quality=level)
+            else:
+                data = gzip.compress(response.get_data(), compresslevel=level, mtime=0)
+            if etag is not None:
+                cache_rendered_map(key, data)
+        response.set_data(data)
+    
+    response.headers['Content-Encoding'] = encoding
+    if etag is not None:
+        response.set_etag(f'{etag}-{encoding}')
+    return response
+
+
 
 #####
 # Folium elements
 #####
 
-# Outline of a study
-def folium_outline(poly, text=None):
-    # Transform the coordinates
-    geo = gpd.GeoSeries([poly])
-    coord = geo.get_coordinates()
-    coord.x, coord.y = coord.y, coord.x
-    
-    # 
-    obj = folium.Polygon(
-        locations = coord,
-        color = 'black',
-        fill = True,
-        fill_opacity = 0,
-        tooltip = text
-    )
+# Data of the zones, as GeoJSON or with the compact transport, the style and the tooltip of each zone are properties of its feature.
+# The compact transport sends the coordinates quantized to the precision (in degrees) and delta encoded,
+# with the offsets of the rings, polygons and geometries, and the layer decodes them to GeoJSON.
+def zones_data(geometries, ids, texts=None, fill_colors=None, fill_opacities=None, compact=False, precision=1e-6):
+    # Keep the zones with a geometry
+    geometries = np.asarray(geometries)
+    kept = np.flatnonzero(~(shapely.is_missing(geometries) | shapely.is_empty(geometries)))
+    geometries = geometries[kept]
+    
+    # Properties
+    properties = [
+        json.dumps({
+            'tooltip': None if texts is None else texts[i],
+            'fillColor': 'black' if fill_colors is None else fill_colors[i],
+            'fillOpacity': 0 if fill_opacities is None else fill_opacities[i]
+        }, separators=(',', ':'))
+        for i in kept
+    ]
+    
+    if not compact:
+        # Features, the geometries are converted all at once
+        geojson = shapely.to_geojson(geometries)
+        features = ','.join(
+            f'{{"type":"Feature","id":{json.dumps(ids[i])},"properties":{properties[j]},"geometry":{geojson[j]}}}'
+            for j, i in enumerate(kept)
+        )
+        data = f'{{"type":"FeatureCollection","features":[{features}]}}'
+    
+    elif len(geometries) == 0:
+        # No zone, to_ragged_array needs geometries
+        data = f'{{"precision":{precision},"translate":[0,0],"coords":[],"rings":[0],"polygons":[0],"geometries":[0],"features":[]}}'
+    
+    else:
+        # Coordinates of all the polygons, with the offsets of the rings, polygons and geometries
+        geometry_type, coords, offsets = shapely.to_ragged_array(geometries)
+        if geometry_type == shapely.GeometryType.POLYGON:
+            offsets = (*offsets, np.arange(len(geometries) + 1))
+        
+        # Quantized and delta encoded
+        translate = coords.min(axis=0) if len(coords) > 0 else np.zeros(2)
+        quantized = np.round((coords - translate) / precision).astype(np.int64)
+        deltas = np.diff(quantized, axis=0, prepend=np.zeros((1, 2), dtype=np.int64))
+        
+        features = ','.join(f'{{"id":{json.dumps(ids[i])},"properties":{properties[j]}}}' for j, i in enumerate(kept))
+        data = (
+            f'{{"precision":{precision},"translate":{json.dumps(translate.tolist())},'
+            f'"coords":{json.dumps(deltas.ravel().tolist(), separators=(",", ":"))},'
+            f'"rings":{json.dumps(offsets[0].tolist(), separators=(",", ":"))},'
+            f'"polygons":{json.dumps(offsets[1].tolist(), separators=(",", ":"))},'
+            f'"geometries":{json.dumps(offsets[2].tolist(), separators=(",", ":"))},'
+            f'"features":[{features}]}}'
+        )
+    
+    return data.replace('</', '<\\/')
+
+# Zones as a single GeoJSON layer, with the leaflet layer of each zone by its id in <name>_zones.
+# <name>_decode gives the GeoJSON of data from zones_data.
+def folium_zones(geometries, ids, texts=None, fill_colors=None, fill_opacities=None, compact=False, precision=1e-6):
+    obj = folium.MacroElement()
+    obj._name = 'Zones'
+    obj.data = zones_data(geometries, ids, texts, fill_colors, fill_opacities, compact, precision)
+    obj._template = branca.element.Template('''
+        {% macro script(this, kwargs) %}
+            function {{ this.get_name() }}_decode(data) {
+                if (data.type === 'FeatureCollection') {
+                    return data;
+                }
+                var features = [];
+                if (!data.features || data.features.length === 0) {
+                    return {type: 'FeatureCollection', features: features};
+                }
+                var x = 0, y = 0, i = 0;
+                for (var g = 0; g < data.features.length; g++) {
+                    var polygons = [];
+                    for (var p = data.geometries[g]; p < data.geometries[g+1]; p++) {
+                        var rings = [];
+                        for (var r = data.polygons[p]; r < data.polygons[p+1]; r++) {
+                            var ring = [];
+                            for (; i < data.rings[r+1]; i++) {
+                                x += data.coords[2*i];
+                                y += data.coords[2*i+1];
+                                ring.push([data.translate[0] + x*data.precision, data.translate[1] + y*data.precision]);
+                            }
+                            rings.push(ring);
+                        }
+                        polygons.push(rings);
+                    }
+                    var feature = data.features[g];
+                    features.push({type: 'Feature', id: feature.id, properties: feature.properties, geometry: {type: 'MultiPolygon', coordinates: polygons}});
+                }
+                return {type: 'FeatureCollection', features: features};
+            }
+            var {{ this.get_name() }}_zones = {};
+            var {{ this.get_name() }} = L.geoJson({{ this.get_name() }}_decode({{ this.data }}), {
+                style: function(feature) {
+                    return {color: 'black', fill: true, fillColor: feature.properties.fillColor, fillOpacity: feature.properties.fillOpacity};
+                },
+                onEachFeature: function(feature, layer) {
+                    {{ this.get_name() }}_zones[feature.id] = layer;
+                    if (feature.properties.tooltip !== null) {
+                        layer.bindTooltip(feature.properties.tooltip, {sticky: true});
+                    }
+                }
+            }).addTo({{ this._parent.get_name() }});
+        {% endmacro %}
+    ''')
     return obj
 
-# Clickable subzone
-def folium_subdiv(poly, colorfill=False, text=None):
-    # Transform the coordinates
-    geo = gpd.GeoSeries([poly])
-    coord = geo.get_coordinates()
-    coord.x, coord.y = coord.y, coord.x
-    
-    # Get the fill
-    if not(colorfill):
-        fill_opactity = 0
-        fill_color = 'black'
-    else:
-        fill_opactity = 0.3
-        fill_color = colorfill
-    
-    # Object
-    obj = folium.Polygon(
-        locations = coord,
-        color = 'black',
-        fill = True,
-        fill_opacity = fill_opactity,
-        fill_color = fill_color,
-        tooltip = text
-    )
+# Loading of the zones seen when the map moves: the zones of the new bounding box that were not in the previous one
+# are asked to the url and added to the layer, all the zones are asked again when the simplification level changes.
+# The names of the added zones are sent to the parent page with postMessage({'viewportZones': zones}).
+def folium_subdiv_viewport(layer, url, bbox, zoom, compact=False):
+    obj = folium.MacroElement()
+    obj.layer = layer
+    obj.url = url
+    obj.bbox = json.dumps(bbox)
+    obj.level = json.dumps(simplification_level(zoom))
+    obj.zooms = json.dumps(simplification_zooms)
+    obj.compact = json.dumps(compact)
+    obj._template = branca.element.Template('''
+        {% macro script(this, kwargs) %}
+            (function() {
+                var map = {{ this._parent.get_name() }};
+                var layer = {{ this.layer.get_name() }};
+                var zones = {{ this.layer.get_name() }}_zones;
+                var previous = {{ this.bbox }};
+                var level = {{ this.level }};
+                var requests = 0;
+                function levelOf(zoom) {
+                    var zooms = {{ this.zooms }};
+                    for (var i = 0; i < zooms.length; i++) {
+                        if (zoom <= zooms[i]) {
+                            return zooms[i];
+                        }
+                    }
+                    return null;
+                }
+                map.on('moveend', function() {
+                    var bounds = map.getBounds().pad(0.25);
+                    var bbox = [bounds.getSouth(), bounds.getWest(), bounds.getNorth(), bounds.getEast()];
+                    var newLevel = levelOf(map.getZoom());
+                    var body = {bbox: bbox, zoom: map.getZoom(), compact: {{ this.compact }}};
+                    if (newLevel === level) {
+                        body.previous = previous;
+                    }
+                    var request = ++requests;
+                    fetch('{{ this.url }}', {method: 'POST', body: JSON.stringify(body)})
+                        .then(function(response) { return response.json(); })
+                        .then(function(response) {
+                            if (request !== requests || response.status !== 'success') {
+                                return;
+                            }
+                            if (newLevel !== level) {
+                                layer.clearLayers();
+                                for (var id in zones) {
+                                    delete zones[id];
+                                }
+                                level = newLevel;
+                            }
+                            var data = {{ this.layer.get_name() }}_decode(response.data);
+                            data.features = data.features.filter(function(feature) { return !(feature.id in zones); });
+                            layer.addData(data);
+                            previous = bbox;
+                            window.parent.postMessage({viewportZones: response.zones}, '*');
+                        });
+                });
+            })();
+        {% endmacro %}
+    ''')
     return obj
 
+# Selection of the subzones in the browser: selectZone(zoneID) fills the zone and empties the previous selection.
+# It can be called from the parent page with postMessage({'selectZone': zoneID}).
+def folium_subdiv_selection(layer, colorfill='red'):
+    obj = folium.MacroElement()
+    obj.layer = layer
+    obj.colorfill = colorfill
+    obj._template = branca.element.Template('''
+        {% macro script(this, kwargs) %}
+            var selectedZone = null;
+            function selectZone(zoneID) {
+                var zones = {{ this.layer.get_name() }}_zones;
+                if (selectedZone !== null && selectedZone in zones) {
+                    zones[selectedZone].setStyle({fillColor: 'black', fillOpacity: 0});
+                }
+                if (zoneID in zones) {
+                    zones[zoneID].setStyle({fillColor: '{{ this.colorfill }}', fillOpacity: 0.3});
+                }
+                selectedZone = zoneID;
+            }
+            window.addEventListener('message', function(event) {
+                if (event.data && event.data.selectZone !== undefined) {
+                    selectZone(event.data.selectZone);
+                }
+            });
+        {% endmacro %}
+    ''')
+    return obj
+
+# Markers of the clusters of studies, the markers of the viewport are asked to the url when the map moves.
+# A study alone is a green point, a cluster shows its number of studies.
+def folium_study_clusters(url, zoom):
+    obj = folium.MacroElement()
+    obj._name = 'StudyClusters'
+    obj.url = url
+    obj.data = clusters_data(zoom)
+    obj._template = branca.element.Template('''
+        {% macro script(this, kwargs) %}
+            var {{ this.get_name() }} = L.layerGroup().addTo({{ this._parent.get_name() }});
+            function {{ this.get_name() }}_show(markers) {
+                var layer = {{ this.get_name() }};
+                layer.clearLayers();
+                markers.forEach(function(marker) {
+                    var item;
+                    if (marker[2] === 1) {
+                        item = L.circleMarker([marker[0], marker[1]], {radius: 7, color: 'darkgreen', fillColor: 'green', fillOpacity: 0.8, weight: 2});
+                    } else {
+                        var size = Math.round(24 + 6 * Math.log10(marker[2]));
+                        item = L.marker([marker[0], marker[1]], {icon: L.divIcon({
+                            html: '<div style="width:' + size + 'px;height:' + size + 'px;line-height:' + size + 'px;border-radius:50%;background:rgba(0,128,0,0.7);color:white;text-align:center;font-weight:bold">' + marker[2] + '</div>',
+                            className: '',
+                            iconSize: [size, size]
+                        })});
+                    }
+                    item.bindTooltip(marker[4]);
+                    item.addTo(layer);
+                });
+            }
+            {{ this.get_name() }}_show({{ this.data }});
+            (function() {
+                var map = {{ this._parent.get_name() }};
+                var requests = 0;
+                map.on('moveend', function() {
+                    var bounds = map.getBounds().pad(0.25);
+                    var body = {zoom: map.getZoom(), bbox: [bounds.getSouth(), bounds.getWest(), bounds.getNorth(), bounds.getEast()]};
+                    var request = ++requests;
+                    fetch('{{ this.url }}', {method: 'POST', body: JSON.stringify(body)})
+                        .then(function(response) { return response.json(); })
+                        .then(function(response) {
+                            if (request === requests && response.status === 'success') {
+                                {{ this.get_name() }}_show(response.markers);
+                            }
+                        });
+                });
+            })();
+        {% endmacro %}
+    ''')
+    return obj
+
+
+
+#####
+# Data processing
+#####
+
+# Precision of the compact coordinates at a simplification level, a quarter of a pixel or about 10 cm at full resolution
+def quantization_precision(level):
+    if level is None:
+        return 1e-6
+    return 360 / (256 * 2**level) / 4
+
+
+# Read the simplification level of a layer displayed at a zoom, or its full resolution, with only the features
+# within the bounding box (south, west, north, east) if one is given and only the columns given if some are
+def read_simplified_level(file_path, zoom, bbox=None, columns=None):
+    level = simplification_level(zoom)
+    if bbox is not None:
+        bbox = (bbox[1], bbox[0], bbox[3], bbox[2]) # as (minx, miny, maxx, maxy), read with the spatial index
+    if level is not None:
+        try:
+            return read_layer(file_path, level, bbox=bbox, columns=columns), level
+        except Exception as e:
+            logger.debug(f'No simplification level {level} in the file {file_path}: {e}.')
+    return read_layer(file_path, bbox=bbox, columns=columns), None
+
+
+# Outline file of a study, in the storage format when there is one in it, None if there is none
+def study_outline(dir_path):
+    extension = storage_extensions[storage_format]
+    for extension in [extension] + [other for other in storage_extensions.values() if other != extension]:
+        file_path = os.path.join(dir_path, 'outline' + extension)
+        if os.path.exists(file_path):
+            return file_path
+    return None
+
+
+# Bounding box [south, west, north, east] seen on a web mercator map at a center and a zoom,
+# in a viewport of a size in pixels with a margin around it
+def viewport_bbox(center, zoom, width=1920, height=1080, margin=0.25):
+    scale = 256 * 2**zoom # pixels around the world
+    lat = max(min(float(center[0]), 85.0511), -85.0511)
+    x = (float(center[1]) + 180) / 360 * scale
+    y = (1 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2 * scale
+    half_width = width * (1 + 2*margin) / 2
+    half_height = height * (1 + 2*margin) / 2
+    west = max((x - half_width) / scale * 360 - 180, -180)
+    east = min((x + half_width) / scale * 360 - 180, 180)
+    north = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * max(y - half_height, 0) / scale))))
+    south = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * min(y + half_height, scale) / scale))))
+    return [south, west, north, east]
+
+
+
+#####
+# Staged uploads
+#####
+
+# Remove the staged files that expired, then the oldest ones while the total size is too big
+def evict_staged_files():
+    global staged_files
+    now = time.time()
+    expired = [token for token, staged in staged_files.items() if now - staged['time'] > staging_ttl]
+    evicted = [staged_files.pop(token) for token in expired]
+    while len(staged_files) > 0 and sum(staged['size'] for staged in staged_files.values()) > staging_max_size:
+        evicted.append(staged_files.popitem(last=False)[1])
+    for staged in evicted:
+        if os.path.exists(staged['zip']):
+            os.remove(staged['zip'])
+
+
+# Remove the staged files left in the folders of the studies by the processes that stopped, by modification time:
+# the ones that expired, then the oldest ones while the total size is too big
+def sweep_staged_files():
+    staged_zips = []
+    for study_data in list(studies.values()):
+        staged_dir = os.path.join(study_data['dir_path'], 'temp', 'staged')
+        if not os.path.isdir(staged_dir):
+            continue
+        for entry in os.scandir(staged_dir):
+            if entry.is_file() and entry.name.endswith('.zip'):
+                stat = entry.stat()
+                staged_zips.append((stat.st_mtime, stat.st_size, entry.path))
+    staged_zips.sort()
+    
+    now = time.time()
+    total_size = sum(size for _, size, _ in staged_zips)
+    removed = 0
+    for staged_time, size, path in staged_zips:
+        if now - staged_time <= staging_ttl and total_size <= staging_max_size:
+            break
+        try:
+            os.remove(path)
+            removed += 1
+        except FileNotFoundError:
+            pass
+        total_size -= size
+    if removed > 0:
+        logger.info(f'{removed} staged files removed.')
+
+
+# Keep a validated upload for the process step and give its token
+def stage_file(studyID, file):
+    global staged_files
+    token = uuid.uuid4().hex
+    dir_path = studies[studyID]['dir_path']
+    staged_zip = os.path.join(dir_path, 'temp', 'staged', f'{token}.zip')
+    os.makedirs(os.path.dirname(staged_zip), exist_ok=True)
+    file.seek(0)
+    if hasattr(file, 'save'):
+        file.save(staged_zip)
+    else:
+        with open(staged_zip, 'wb') as staged_file:
+            shutil.copyfileobj(file, staged_file)
+    with staged_files_lock:
+        staged_files[token] = {
+            'study': studyID,
+            'zip': staged_zip,
+            'size': os.path.getsize(staged_zip),
+            'time': time.time()
+        }
+        evict_staged_files()
+    return token
+
+
+# Read the schema of the shapefile of a staged zipfile
+def read_staged_schema(studyID, token):
+    shapefile_zip = open_shapefile_zip(get_staged_file(studyID, token))
+    try:
+        return read_shapefile_schema(shapefile_zip)
+    finally:
+        shapefile_zip['zip'].close()
+
+
+# Stage each shapefile of an uploaded zipfile on its own, with its schema
+def stage_shapefiles(studyID, file):
+    staged = []
+    shapefiles = open_shapefiles_zip(file.stream)
+    try:
+        for shp_file, shapefile_zip in shapefiles.items():
+            if len(shapefiles) == 1:
+                token = stage_file(studyID, file)
+            else:
+                buffer = io.BytesIO()
+                write_shapefile_zip(shapefile_zip, buffer)
+                token = stage_file(studyID, buffer)
+            staged.append({'shapefile': shp_file, 'token': token})
+            staged[-1]['schema'] = read_staged_schema(studyID, token)
+    except Exception:
+        # Release the shapefiles staged before the error
+        for shapefile in staged:
+            release_staged_file(shapefile['token'])
+        raise
+    finally:
+        next(iter(shapefiles.values()))['zip'].close()
+    return staged
+
+
+# Get the zipfile staged for a study, None if it expired. A zipfile staged by another process is found in the folder of the study.
+def get_staged_file(studyID, token):
+    global staged_files
+    with staged_files_lock:
+        evict_staged_files()
+        staged_zip = os.path.join(studies[studyID]['dir_path'], 'temp', 'staged', f'{token}.zip')
+        if token not in staged_files and all(c in '0123456789abcdef' for c in token) and os.path.exists(staged_zip):
+            staged_time = os.path.getmtime(staged_zip)
+            if time.time() - staged_time <= staging_ttl:
+                staged_files[token] = {'study': studyID, 'zip': staged_zip, 'size': os.path.getsize(staged_zip), 'time': staged_time}
+        staged = staged_files.get(token)
+        if staged is None or staged['study'] != studyID or not os.path.exists(staged['zip']):
+            return None
+        return staged['zip']
+
+
+# Remove a staged file once it has been processed
+def release_staged_file(token):
+    global staged_files
+    with staged_files_lock:
+        staged = staged_files.pop(token, None)
+    if staged is not None and os.path.exists(staged['zip']):
+        os.remove(staged['zip'])
+
+
+
+#####
+# Jobs
+#####
+
+# Start the pool of processes and the thread following the progress of the jobs, the lock must be held
+def start_jobs_pool():
+    global jobs_pool, jobs_progress
+    context = multiprocessing.get_context('spawn')
+    jobs_progress = context.Queue()
+    jobs_pool = ProcessPoolExecutor(max_workers=jobs_max_workers, mp_context=context, initializer=init_worker, initargs=(jobs_progress, jobs_reprojection_threads))
+    threading.Thread(target=follow_jobs_progress, args=(jobs_progress,), daemon=True).start()
+
+
+# Submit the tasks of a job to the pool and give their futures, the lock must be held. A pool broken by the death
+# of a worker, killed when it is out of memory for example, is started again.
+def submit_tasks(jobID, cancel, tasks):
+    global jobs_pool
+    if jobs_pool is None:
+        start_jobs_pool()
+    slots = {'dir': jobs_dir, 'count': jobs_max_workers}
+    try:
+        return [jobs_pool.submit(run_task, function, {'id': jobID, 'task': i, 'cancel': cancel, 'slots': slots}, *args) for i, (function, args) in enumerate(tasks)]
+    except BrokenProcessPool:
+        logger.error('The pool of the jobs is broken, it is started again.')
+        jobs_pool.shutdown(wait=False, cancel_futures=True)
+        start_jobs_pool()
+        return [jobs_pool.submit(run_task, function, {'id': jobID, 'task': i, 'cancel': cancel, 'slots': slots}, *args) for i, (function, args) in enumerate(tasks)]
+
+
+# Set the stage of a job or a task, with the time spent in the previous stage added to its timing, the lock must be held
+def set_stage(item, stage, progress=None):
+    now = time.time()
+    item['timings'][item['stage']] = item['timings'].get(item['stage'], 0) + now - item['stage_time']
+    item['stage'] = stage
+    item['stage_time'] = now
+    if progress is not None:
+        item['progress'] = progress
+
+
+# Update the tasks of the jobs with the progress sent by the workers. A job of a single task follows its stages,
+# a job of several tasks is at the ingest stage while they run.
+def follow_jobs_progress(progress_queue):
+    global jobs
+    while True:
+        jobID, i, stage, progress = progress_queue.get()
+        with jobs_lock:
+            job = jobs.get(jobID)
+            if job is None or job['state'] not in ['queued', 'running']:
+                continue
+            task = job['tasks'][i]
+            set_stage(task, stage, progress)
+            job['state'] = 'running'
+            job['progress'] = sum(task['progress'] for task in job['tasks']) / len(job['tasks'])
+            job_stage = stage if len(job['tasks']) == 1 else 'ingest'
+            if job['stage'] != job_stage:
+                set_stage(job, job_stage)
+        try:
+            save_job(job)
+        except Exception as e:
+            logger.error(f'An error has occured while saving the job {jobID}: {e}.')
+
+
+# Size of the batches to ingest a shapefile found by open_shapefile_zip in, None to read it at once, and the extension
+# of the file it is saved to. A GeoParquet file cannot be saved in batches, the big files are then geopackages.
+def ingestion_mode(shapefile_zip):
+    if shapefile_size(shapefile_zip) > ingestion_batch_min_size:
+        return ingestion_batch_size, storage_extensions['gpkg']
+    return None, storage_extensions[storage_format]
+
+
+# Ingestion mode of a staged zipfile, the ones that cannot be opened are read at once so that their job reports them
+def staged_ingestion_mode(source):
+    try:
+        shapefile_zip = open_shapefile_zip(source)
+    except Exception:
+        return None, storage_extensions[storage_format]
+    try:
+        return ingestion_mode(shapefile_zip)
+    finally:
+        shapefile_zip['zip'].close()
+
+
+# Remove the finished jobs that expired, in the process and in the database
+def evict_jobs(con):
+    global jobs
+    now = time.time()
+    for jobID in [jobID for jobID, job in jobs.items() if job['finished'] is not None and now - job['finished'] > jobs_ttl]:
+        jobs.pop(jobID)
+    con.execute('DELETE FROM jobs WHERE finished < ?', (now - jobs_ttl,))
+
+
+# Save the state of a job in the database, so that every process of the app can give it. A finished job is not changed,
+# by the state of an earlier progress saved after it for example.
+def save_job(job):
+    with jobs_lock:
+        state = json.dumps(job_state(job))
+        finished = job['finished']
+    con = get_connection(os.path.join('data', 'studies.db'))
+    con.execute('''
+        INSERT INTO jobs (id, pid, finished, job) VALUES (?, ?, ?, ?)
+        ON CONFLICT (id) DO UPDATE SET finished = excluded.finished, job = excluded.job WHERE jobs.finished IS NULL
+    ''', (job['id'], os.getpid(), finished, state))
+
+
+# Check if the process of a job is running, a job of this process is running until it is finished
+def job_process_alive(jobID, pid):
+    if pid == os.getpid():
+        return jobID in jobs
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+# Finish as an error a job of the database whose process stopped, and give its state
+def finish_lost_job(con, jobID, state):
+    state.update({'state': 'error', 'stage': 'error', 'message': ['The process of the job stopped.']})
+    con.execute('UPDATE jobs SET finished = ?, job = ? WHERE id = ?', (time.time(), json.dumps(state), jobID))
+    logger.error(f'The process of the {state["type"]} job {jobID} stopped.')
+    return state
+
+
+# Number of the jobs of every process that are not finished
+def pending_jobs(con):
+    pending = 0
+    for jobID, pid, state in con.execute('SELECT id, pid, job FROM jobs WHERE finished IS NULL').fetchall():
+        if job_process_alive(jobID, pid):
+            pending += 1
+        else:
+            finish_lost_job(con, jobID, json.loads(state))
+    return pending
+
+
+# State of a job for the responses, from the jobs of the process or from the database for the jobs of another process.
+# None if there is no such job.
+def find_job_state(jobID):
+    with jobs_lock:
+        job = jobs.get(jobID)
+        if job is not None:
+            return job_state(job)
+    con = get_connection(os.path.join('data', 'studies.db'))
+    row = con.execute('SELECT pid, finished, job FROM jobs WHERE id = ?', (jobID,)).fetchone()
+    if row is None:
+        return None
+    state = json.loads(row[2])
+    if row[1] is None and not job_process_alive(jobID, row[0]):
+        state = finish_lost_job(con, jobID, state)
+    return state
+
+
+# Run tasks of ingestion in the pool, as (function, args) with the job as first argument of the function. Once they are
+# all done, the finalize function is called in the app with their outcomes, as {'result': result} or {'exception': e},
+# it registers the outputs and gives the result of the job. The temporary files are removed once the job is finished.
+# Returns the ID of the job, None if too many are pending in all the processes of the app. The job is only kept
+# once its tasks are submitted, its state is then saved in the database.
+def submit_job(type, studyID, tasks, finalize, temporary_files=None):
+    global jobs
+    jobID = uuid.uuid4().hex
+    os.makedirs(jobs_dir, exist_ok=True)
+    con = get_connection(os.path.join('data', 'studies.db'))
+    with jobs_lock, transaction(con):
+        evict_jobs(con)
+        if pending_jobs(con) >= jobs_max_pending:
+            return None
+        job = {
+            'id': jobID,
+            'type': type,
+            'study': studyID,
+            'state': 'queued',
+            'stage': 'queued',
+            'progress': 0,
+            'timings': {},
+            'tasks': [{'stage': 'queued', 'progress': 0, 'timings': {}, 'stage_time': time.time()} for task in tasks],
+            'result': None,
+            'message': None,
+            'time': time.time(),
+            'stage_time': time.time(),
+            'finished': None,
+            'cancel': os.path.join(jobs_dir, f'{jobID}.cancel'),
+            'finalize': finalize,
+            'temporary_files': list(temporary_files or []),
+            'remaining': len(tasks)
+        }
+        job['futures'] = submit_tasks(jobID, job['cancel'], tasks)
+        jobs[jobID] = job
+        con.execute('INSERT INTO jobs (id, pid, finished, job) VALUES (?, ?, NULL, ?)', (jobID, os.getpid(), json.dumps(job_state(job))))
+    for future in job['futures']:
+        future.add_done_callback(lambda future: finish_task(jobID))
+    return jobID
+
+
+# Count the finished tasks of a job, and finish it with the last one
+def finish_task(jobID):
+    with jobs_lock:
+        job = jobs[jobID]
+        job['remaining'] -= 1
+        if job['remaining'] > 0:
+            return
+    finish_job(job)
+
+
+# Outcome of a task for the finalize function of its job, a failure while reading or cleaning the file is a bad file,
+# unless its worker died
+def task_outcome(job, i):
+    future = job['futures'][i]
+    if future.cancelled():
+        return {'exception': Exception('The job was cancelled.'), 'badfile': False}
+    if isinstance(future.exception(), BrokenProcessPool):
+        return {'exception': Exception('The worker of the job stopped, the file may be too big.'), 'badfile': False}
+    if future.exception() is not None:
+        return {'exception': future.exception(), 'badfile': job['tasks'][i]['stage'] in ['read', 'clean']}
+    return {'result': future.result()}
+
+
+# Result of a task, its exception is raised if it failed
+def task_result(outcome):
+    if 'exception' in outcome:
+        raise outcome['exception']
+    return outcome['result']
+
+
+# Give the result of a finished job, when it fails with the exception of a task it is a bad file if the task is one
+def finish_job(job):
+    outcomes = [task_outcome(job, i) for i in range(len(job['futures']))]
+    cancelled = os.path.exists(job['cancel']) or any(future.cancelled() for future in job['futures'])
+    with jobs_lock:
+        set_stage(job, 'register')
+    
+    try:
+        if cancelled:
+            raise Exception('The job was cancelled.')
+        result = job['finalize'](outcomes)
+        state = 'success'
+        message = None
+        
+    except Exception as e:
+        badfile = any(outcome.get('exception') is e and outcome['badfile'] for outcome in outcomes)
+        result = None
+        state = 'cancelled' if cancelled else 'badfile' if badfile else 'error'
+        message = e.args
+        if not cancelled:
+            logger.error(f'An error has occured during the {job["type"]} job {job["id"]}: {e}.')
+    
+    # Remove the temporary files
+    for path in job['temporary_files'] + [job['cancel']]:
+        if os.path.exists(path):
+            os.remove(path)
+    
+    with jobs_lock:
+        set_stage(job, state, 1)
+        job['state'] = state
+        job['result'] = result
+        job['message'] = message
+        job['finished'] = time.time()
+    save_job(job)
+    record_job(job)
+
+
+# Cancel a job, its queued tasks at once and the running ones at their next stage, and give its state. A job of another
+# process is cancelled by its cancel file, its tasks stop at their next stage. None if there is no such job.
+# The lock is not held while cancelling, the job may then be finished in this thread.
+def cancel_job(jobID):
+    with jobs_lock:
+        job = jobs.get(jobID)
+    if job is None:
+        state = find_job_state(jobID)
+        if state is not None and state['state'] in ['queued', 'running']:
+            pathlib.Path(os.path.join(jobs_dir, f'{jobID}.cancel')).touch()
+        return state
+    if job['finished'] is None:
+        pathlib.Path(job['cancel']).touch()
+        for future in job['futures']:
+            future.cancel()
+    with jobs_lock:
+        return job_state(job)
+
+
+# State of a job for the responses, with the stage, progress and timings of its tasks when it has several
+def job_state(job):
+    state = {key: job[key] for key in ['id', 'type', 'study', 'state', 'stage', 'progress', 'timings', 'result', 'message']}
+    if len(job['tasks']) > 1:
+        state['tasks'] = [{key: task[key] for key in ['stage', 'progress', 'timings']} for task in job['tasks']]
+    return state
+
+
+
+#####
+# Rendered maps cache
+#####
+
+# Get a rendered map, None if it is not in the cache
+def get_rendered_map(key):
+    with rendered_maps_lock:
+        iframe = rendered_maps.get(key)
+        if iframe is not None:
+            rendered_maps.move_to_end(key)
+        return iframe
+
+
+# Put a rendered map in the cache, the least recently used ones are removed when it is full
+def cache_rendered_map(key, iframe):
+    global rendered_maps
+    with rendered_maps_lock:
+        rendered_maps[key] = iframe
+        rendered_maps.move_to_end(key)
+        while len(rendered_maps) > 1 and sum(len(cached) for cached in rendered_maps.values()) > rendered_maps_max_size:
+            rendered_maps.popitem(last=False)
+
+
+# Remove the maps of a study, with its files, and the maps of the studies manager
+def invalidate_rendered_maps(studyID):
+    global rendered_maps, studies_version
+    with rendered_maps_lock:
+        studies_version += 1
+        for key in [key for key in rendered_maps if key[0] == 'studies_manager' or key[1] == studyID]:
+            rendered_maps.pop(key)
+
+
+
+# Remove all the rendered maps
+def clear_rendered_maps():
+    global rendered_maps, studies_version
+    with rendered_maps_lock:
+        studies_version += 1
+        rendered_maps.clear()
+
+
+
+#####
+# Spatial indexes
+#####
+
+# Get the spatial index of a subdivision, it is built the first time and kept until the file changes
+def get_spatial_index(file_path):
+    global spatial_indexes
+    file_stat = os.stat(file_path)
+    key = (file_path, file_stat.st_mtime_ns, file_stat.st_size)
+    with spatial_indexes_lock:
+        if key in spatial_indexes:
+            spatial_indexes.move_to_end(key)
+            return spatial_indexes[key]
+        
+        # Build the index of the zones
+        data_subdiv = read_layer(file_path, columns=['zone_id', 'zone_name', 'clean'])
+        data_subdiv.to_crs(epsg=4326, inplace=True)
+        index = {
+            'tree': shapely.STRtree(data_subdiv.geometry.values),
+            'ids': data_subdiv['zone_id'].tolist(),
+            'names': data_subdiv['zone_name'].tolist(),
+            'clean': data_subdiv['clean'].tolist()
+        }
+        
+        # Keep it, without the older versions of the file
+        for old_key in [old_key for old_key in spatial_indexes if old_key[0] == file_path]:
+            spatial_indexes.pop(old_key)
+        spatial_indexes[key] = index
+        while len(spatial_indexes) > spatial_indexes_max_count:
+            spatial_indexes.popitem(last=False)
+        return index
+
+
+# Zone of a spatial index as a dict
+def indexed_zone(index, i):
+    return {'id': index['ids'][i], 'name': index['names'][i], 'clean': index['clean'][i]}
+
+
+
+#####
+# Jobs of ingestion
+#####
+
+# State of a job: queued, running, success, badfile, error or cancelled, with its stage, progress and timings,
+# and its result once it succeeded
+@app.route('/jobs/<jobID>')
+def job_status(jobID):
+    state = find_job_state(jobID)
+    if state is None:
+        return jsonify({'status':'unexisting'})
+    return jsonify({'status':'success', 'job':state})
+
+
+# Cancel a job
+@app.route('/jobs/<jobID>/cancel', methods=['POST'])
+def job_cancel(jobID):
+    state = cancel_job(jobID)
+    if state is None:
+        logger.info(f'Cannot cancel, no job with ID {jobID}.')
+        return jsonify({'status':'unexisting'})
+    logger.info(f'The job with ID {jobID} was cancelled.')
+    return jsonify({'status':'success', 'job':state})
+
+
+
+#####
+# Metrics
+#####
+
+# Metrics of the requests and the jobs of this process in the Prometheus text format, only for local clients
+@app.route('/metrics')
+def metrics_endpoint():
+    if request.remote_addr not in ['127.0.0.1', '::1']:
+        return jsonify({'status':'forbidden'}), 403
+    return app.response_class(metrics_text(), mimetype='text/plain; version=0.0.4')
+
 
 
 #####
@@ -189,26 +1674,143 @@ def studies_manager():
     global studies
     
     try:
+        # Not modified since the version of the studies and of the catalog the client has
+        con = get_connection(os.path.join('data', 'studies.db'))
+        etag = None
+        if studies_db_version is not None:
+            etag = response_etag(('studies_manager', studies_db_version, con.execute('SELECT version FROM catalog_registry').fetchone()[0]))
+            response = not_modified(etag)
+            if response is not None:
+                return response
+        
         # Map
-        map = folium.Map()
-        for study in studies.keys():
-            folium.Marker(
-                location=[studies[study]['lat'], studies[study]['lon']],
-                tooltip=studies[study]['name'],
-                icon=folium.Icon(color='green')
-            ).add_to(map)
-        iframe = map.get_root()._repr_html_()
-        
-        # List of studies
-        studiesList = [{'id':study, 'name':studies[study]['name'], 'visibility':studies[study]['visibility']} for study in studies.keys()]
-        return jsonify({'status':'success', 'iframe':str(iframe), 'studies':studiesList})
+        key = ('studies_manager', studies_version)
+        iframe = get_rendered_map(key)
+        if iframe is None:
+            with stage_timer('render'):
+                map = folium.Map()
+                folium_study_clusters(url_for('studies_manager_clusters'), map.options['zoom']).add_to(map)
+            with stage_timer('serialize'):
+                iframe = map.get_root()._repr_html_()
+            cache_rendered_map(key, iframe)
+        
+        # List of studies, with their number of files from the catalog
+        with stage_timer('query'):
+            nb_files = dict(con.execute('SELECT study_id, COUNT(*) FROM catalog GROUP BY study_id').fetchall())
+            studiesList = [{'id':study, 'name':studies[study]['name'], 'visibility':studies[study]['visibility'], 'files':nb_files.get(study, 0)} for study in studies.keys()]
+        with stage_timer('jsonify'):
+            return etag_response(jsonify({'status':'success', 'iframe':str(iframe), 'studies':studiesList}), etag)
+
+    except Exception as e:
+        logger.error(f'Failed to retrieve the data for the studies manager: {e}.')
+        return jsonify({'status':'error'})
+
+
+# Page of the list of studies, sorted and filtered by visibility, bounding box and text in the name or the description
+# Arguments: page, pageSize, sort (id, name, lat, lon, visibility or relevance), order (asc or desc),
+# visibility (true or false), bbox (south,west,north,east) and search
+@app.route('/studies_manager/list')
+def studies_manager_list():
+    try:
+        # Get the arguments
+        page = max(int(request.args.get('page', 1)), 1)
+        page_size = min(max(int(request.args.get('pageSize', 50)), 1), 500)
+        search = request.args.get('search', '').strip()
+        sort = request.args.get('sort', 'relevance' if search else 'name')
+        order = request.args.get('order', 'asc').lower()
+        visibility = request.args.get('visibility')
+        bbox = request.args.get('bbox')
+        sort_columns = {
+            'id': 'studies.id',
+            'name': 'studies.name COLLATE NOCASE',
+            'lat': 'studies.lat',
+            'lon': 'studies.lon',
+            'visibility': 'studies.visibility'
+        }
+        if search:
+            sort_columns['relevance'] = 'bm25(studies_search)'
+        if sort not in sort_columns or order not in ['asc', 'desc'] or visibility not in [None, 'true', 'false']:
+            raise ValueError(f'Unknown sort {sort}, order {order} or visibility {visibility}')
+        
+    except Exception as e:
+        logger.error(f'An error has occured while getting the request: {e}.')
+        return jsonify({'status': 'error'})
+    
+    try:
+        # Filters
+        tables = 'studies'
+        conditions = []
+        parameters = []
+        if search:
+            # Each word is searched as a prefix, the quotes keep the words from being read as operators,
+            # the cross join makes the search index the outer loop of the query
+            tables = 'studies_search CROSS JOIN studies ON studies.id = studies_search.rowid'
+            conditions.append('studies_search MATCH ?')
+            parameters.append(' '.join('"' + word.replace('"', '""') + '"*' for word in search.split()))
+        if visibility is not None:
+            conditions.append('studies.visibility = ?')
+            parameters.append(visibility == 'true')
+        if bbox:
+            south, west, north, east = [float(value) for value in bbox.split(',')]
+            conditions.append('studies.lat BETWEEN ? AND ? AND studies.lon BETWEEN ? AND ?')
+            parameters += [south, north, west, east]
+        where = f'WHERE {" AND ".join(conditions)}' if conditions else ''
+        
+        # Total and page of the studies
+        with stage_timer('query'):
+            con = get_connection(os.path.join('data', 'studies.db'))
+            total = con.execute(f'SELECT COUNT(*) FROM {tables} {where}', parameters).fetchone()[0]
+            rows = con.execute(f'''
+                SELECT
+                    studies.id,
+                    studies.name,
+                    studies.desc,
+                    studies.lat,
+                    studies.lon,
+                    studies.visibility,
+                    (SELECT COUNT(*) FROM catalog WHERE catalog.study_id = studies.id)
+                FROM {tables}
+                {where}
+                ORDER BY {sort_columns[sort]} {order}, studies.id {order}
+                LIMIT ? OFFSET ?
+            ''', parameters + [page_size, (page - 1) * page_size]).fetchall()
+        studiesList = [
+            {'id':row[0], 'name':row[1], 'desc':row[2], 'lat':row[3], 'lon':row[4], 'visibility':(row[5] == 1), 'files':row[6]}
+            for row in rows
+        ]
+        with stage_timer('jsonify'):
+            return jsonify({'status':'success', 'studies':studiesList, 'total':total, 'page':page, 'pageSize':page_size})
+    
+    except Exception as e:
+        logger.error(f'Failed to retrieve the list of studies: {e}.')
+        return jsonify({'status':'error'})
 
+
+# Markers of the clusters of studies seen in a viewport
+@app.route('/studies_manager/clusters', methods=['POST'])
+def studies_manager_clusters():
+    try:
+        # Get the request, the bounding box is [south, west, north, east]
+        data = json.loads(request.get_data())
+        zoom = int(data['zoom'])
+        bbox = data.get('bbox')
+        bbox = None if bbox is None else [float(value) for value in bbox]
+        
+    except Exception as e:
+        logger.error(f'An error has occured while getting the request: {e}.')
+        return jsonify({'status': 'error'})
+    
+    try:
+        with stage_timer('clusters'):
+            markers = clusters_data(zoom, bbox)
+        return app.response_class(f'{{"status":"success","markers":{markers}}}', mimetype='application/json')
+    
     except Exception as e:
-        logger.error(f'Failed to retrieve the data for the studies manager: {e}.')
-        return jsonify({'status':'error'})
+        logger.error(f'Failed to retrieve the clusters of the studies: {e}.')
+        return jsonify({'status': 'error'})
 
 
-# Create the study and register it in the dictionnary and the database
+# Create the study in a job, it is registered in the dictionnary and the database once its outline is saved
 @app.route('/studies_manager/create', methods=['POST'])
 def studies_manager_create():
 
@@ -216,8 +1818,8 @@ def studies_manager_create():
     try:
         name = request.form.get('studyName')
         desc = request.form.get('studyDesc')
-        lat = request.form.get('studyLat')
-        lon = request.form.get('studyLon')
+        lat = float(request.form.get('studyLat'))
+        lon = float(request.form.get('studyLon'))
         outline_file = request.files.get('studyOutline')
         
     except Exception as e:
@@ -225,155 +1827,92 @@ def studies_manager_create():
         logger.error(f'An error has occured while getting the request: {e}.')
         return jsonify({'status':'error'})
     
-    # Add the study to the database 1/2
-    try:
-        studies_db_path = os.path.join('data', 'studies.db')
-        con = sqlite3.connect(studies_db_path)
-        cursor = con.cursor()
-        cursor.execute('''
-            INSERT INTO studies (
-                name,
-                desc,
-                lat,
-                lon
-            ) VALUES (?, ?, ?, ?)
-        ''', (
-            name,
-            desc,
-            lat,
-            lon
-        ))
-        con.commit()
-        
-    except Exception as e:
-        # Return the error
-        con.close()
-        logger.error(f'An error has occured while trying to add the study to the database 1/2: {e}.')
-        return jsonify({'status':'error'})
-    
-    # Get the id
-    studyID = cursor.lastrowid
-    studyID = int(studyID)
-    
-    # Create the directory
-    dir_path = os.path.join('data', f'{studyID} - {name}')
-    os.makedirs(dir_path, exist_ok=False)
-    os.makedirs(os.path.join(dir_path, 'temp'), exist_ok=True)
-    
-    # Add the study to the database 2/2
-    try:
-        cursor.execute(f'''
-            UPDATE studies
-            SET dir_path = ?,
-                visibility = ?
-            WHERE id = {studyID}
-        ''', (
-            dir_path,
-            False
-        ))
-        con.commit()
-        
-    except Exception as e:
-        # Delete from the db
-        cursor.execute(f'''
-            DELETE FROM studies
-            WHERE id = {studyID}
-        ''')
-        con.commit()
-        con.close()
-        # Delete the directory
-        shutil.rmtree(dir_path)
-        # Return the error
-        logger.error(f'An error has occured while trying to add the study to the database 2/2: {e}.')
-        return jsonify({'status':'error'})
-    
-    # Download the shapefile
-    try:
-        # Download the zipfile
-        temp_zip = os.path.join(dir_path, 'temp', 'outline.zip')
-        outline_file.save(temp_zip)
-        # Unzip it
-        temp_folder = os.path.join(dir_path, 'temp', 'outline')
-        with zipfile.ZipFile(temp_zip, 'r') as zip_file:
-            zip_file.extractall(temp_folder)
-        # Take the files only, and not the potential folder with the files within
-        if len([f for f in os.listdir(temp_folder) if f.endswith('.shp')]) == 0:
-            temp_file_folder = os.path.join(temp_folder, os.listdir(temp_folder)[0])
-        else:
-            temp_file_folder = temp_folder
-    
-    except Exception as e:
-        # Delete from the db
-        cursor.execute(f'''
-            DELETE FROM studies
-            WHERE id = {studyID}
-        ''')
-        con.commit()
-        con.close()
-        # Delete the directory
-        shutil.rmtree(dir_path)
-        # Return the error
-        logger.error(f'An error has occured while trying to download the file: {e}.')
-        return jsonify({'status':'error'})
-    
-    # Save the file
+    # Check the shapefile within the zipfile, and keep it for the job
     try:
-        # Get the different files
-        shp_files = [f for f in os.listdir(temp_file_folder) if f.endswith('.shp')]
-        shx_files = [f for f in os.listdir(temp_file_folder) if f.endswith('.shx')]
-        dbf_files = [f for f in os.listdir(temp_file_folder) if f.endswith('.dbf')]
-        
-        # Check if the folder as a single shapefile and the mandatory files
-        count = len(shp_files) + len(shx_files) + len(dbf_files)
-        nb_mandatory_files = 3 # shp, shx and dbf
-        if count > nb_mandatory_files:
-            raise Exception('There are multiple shapefiles within the zipfile.')
-        elif count < nb_mandatory_files:
-            raise Exception('The shapefile is incomplete.')
-        
-        # Read the file
-        shapefile = os.path.join(temp_file_folder, shp_files[0])
-        data_outline = gpd.read_file(shapefile)
-        data_outline.to_crs(epsg=4326, inplace=True)
-        data_outline.rename(columns={'fid': 'old_fid'}, inplace=True) # avoid conflict with geopackage
-        
-        # Remove the temps
-        os.remove(temp_zip)
-        shutil.rmtree(temp_folder)
-        
-        # Save the geo dataframe
-        outline_gpkg = os.path.join(dir_path, 'outline.gpkg')
-        data_outline.to_file(outline_gpkg, driver='GPKG') 
+        with stage_timer('read'):
+            shapefile_zip = open_shapefile_zip(outline_file.stream)
+            batch_size, extension = ingestion_mode(shapefile_zip)
+            shapefile_zip['zip'].close()
+        with stage_timer('stage'):
+            token = uuid.uuid4().hex
+            os.makedirs(jobs_dir, exist_ok=True)
+            outline_zip = os.path.join(jobs_dir, f'{token}.zip')
+            outline_layer = os.path.join(jobs_dir, token + extension)
+            outline_file.stream.seek(0)
+            outline_file.save(outline_zip)
         
     except Exception as e:
-        # Delete from the db
-        cursor.execute(f'''
-            DELETE FROM studies
-            WHERE id = {studyID}
-        ''')
-        con.commit()
-        con.close()
-        # Delete the directory
-        shutil.rmtree(dir_path)
         # Return the error
         logger.error(f'An error has occured while reading the file: {e}.')
         return jsonify({'status':'badfile', 'message': e.args})
     
-    con.close()
+    # Register the study once its outline is read and saved
+    def finalize(outcomes):
+        result = task_result(outcomes[0])
+        
+        # Add the study to the database and the dictionnary
+        global studies
+        with studies_transaction() as con:
+            studyID = con.execute('''
+                INSERT INTO studies (
+                    name,
+                    desc,
+                    lat,
+                    lon,
+                    visibility
+                ) VALUES (?, ?, ?, ?, ?)
+            ''', (
+                name,
+                desc,
+                lat,
+                lon,
+                False
+            )).lastrowid
+            studyID = int(studyID)
+            dir_path = os.path.join('data', f'{studyID} - {name}')
+            con.execute('''
+                UPDATE studies
+                SET dir_path = ?
+                WHERE id = ?
+            ''', (
+                dir_path,
+                studyID
+            ))
+            
+            # Move the file to the directory, the study is not added when it fails
+            try:
+                os.makedirs(dir_path, exist_ok=False)
+                os.makedirs(os.path.join(dir_path, 'temp'), exist_ok=True)
+                os.replace(outline_layer, os.path.join(dir_path, 'outline' + extension))
+                
+            except Exception as e:
+                # Delete the directory
+                shutil.rmtree(dir_path, ignore_errors=True)
+                raise
+            
+            studies[studyID] = {}
+            studies[studyID]['name'] = name 
+            studies[studyID]['desc'] = desc 
+            studies[studyID]['lat'] = lat
+            studies[studyID]['lon'] = lon
+            studies[studyID]['dir_path'] = dir_path
+            studies[studyID]['visibility'] = False
+        cluster_study(studyID)
+        invalidate_rendered_maps(studyID)
+        
+        logger.info(f'The study "{name}" was created succesfuly.')
+        return {'id': studyID, 'timings': result['timings'], 'levels': result['levels']}
     
-    # Add the study to the dictionnary
-    global studies
-    studies[studyID] = {}
-    studies[studyID]['name'] = name 
-    studies[studyID]['desc'] = desc 
-    studies[studyID]['lat'] = lat
-    studies[studyID]['lon'] = lon
-    studies[studyID]['dir_path'] = dir_path
-    studies[studyID]['visibility'] = False
+    # Read, reproject and save the outline in a job
+    with stage_timer('submit'):
+        jobID = submit_job('outline', None, [(ingest_outline, (outline_zip, outline_layer, batch_size))], finalize, temporary_files=[outline_zip, outline_layer])
+    if jobID is None:
+        os.remove(outline_zip)
+        logger.info('Cannot create the study, too many jobs are pending.')
+        return jsonify({'status':'busy'})
     
-    # Return the success
-    logger.info(f'The study "{name}" was created succesfuly.')
-    return jsonify({'status':'success', 'id':studyID})
+    # Return the job, its result gives the ID of the study
+    return jsonify({'status':'success', 'jobID':jobID})
     
     
 
@@ -425,27 +1964,46 @@ def study_map(studyID):
         name = studies[studyID]['name']
         lat = studies[studyID]['lat']
         lon = studies[studyID]['lon']
+        zoom = int(request.args.get('zoom', 10)) # default folium zoom
+        compact = request.args.get('compact', 'false').lower() in ['1', 'true']
         
-        # Map
-        map = folium.Map(location=[lat,lon], start_zoom=10)
+        # Get the map from the cache, the key changes with the outline file and the displayed data
         dir_path = studies[studyID]['dir_path']
-        file = os.path.join(dir_path, 'outline.gpkg')
-        shape = gpd.read_file(file)
-        shape.to_crs(epsg=4326, inplace=True)
-        
-        # Display the zone
-        for _, zone in shape.iterrows():
-            if zone.geometry.geom_type == 'Polygon':
-                poly = folium_outline(zone.geometry, text=name)
-                poly.add_to(map)
-            elif zone.geometry.geom_type == 'MultiPolygon':
-                for subzone in list(zone.geometry.geoms):
-                    poly = folium_outline(subzone, text=name)
-                    poly.add_to(map)
+        file = study_outline(dir_path)
+        file_stat = os.stat(file)
+        key = ('study_map', studyID, file, file_stat.st_mtime_ns, file_stat.st_size, name, lat, lon, zoom, compact)
+        etag = response_etag(key)
+        response = not_modified(etag)
+        if response is not None:
+            return response
+        iframe = get_rendered_map(key)
+        
+        if iframe is None:
+            # Map
+            with stage_timer('read'):
+                shape, level = read_simplified_level(file, zoom, columns=[])
+            with stage_timer('reproject'):
+                shape.to_crs(epsg=4326, inplace=True)
+            
+            # Display the zone
+            with stage_timer('render'):
+                map = folium.Map(location=[lat,lon], zoom_start=zoom)
+                folium_zones(
+                    shape.geometry.values,
+                    list(range(len(shape))),
+                    texts=[name]*len(shape),
+                    compact=compact,
+                    precision=quantization_precision(level)
+                ).add_to(map)
+            count_features(len(shape))
+            
+            with stage_timer('serialize'):
+                iframe = map.get_root()._repr_html_()
+            cache_rendered_map(key, iframe)
         
         # Return the iframe
-        iframe = map.get_root()._repr_html_()
-        return jsonify({'status':'success', 'iframe':str(iframe)})
+        with stage_timer('jsonify'):
+            return etag_response(jsonify({'status':'success', 'iframe':str(iframe)}), etag)
                     
     except Exception as e:
         # Return the error
@@ -465,30 +2023,21 @@ def study_files(studyID):
         return jsonify({'status':'unexisting'})
     
     try:
-        # Get the information
-        name = studies[studyID]['name']
-        
-        # Connect to the files database
-        dir_path = os.path.join('data', f'{studyID} - {name}')
-        study_db_path = os.path.join(dir_path, 'files.db')
-        con = sqlite3.connect(study_db_path)
-        cursor = con.cursor()
-        
-        # Get the files
+        # Get the files and their metadata from the catalog
         global file_types
-        total_files = {}
-        for type in file_types:
-            files = {}
-            try:
-                for row in cursor.execute(f'SELECT * FROM {type}'):
-                    files[row[0]] = row[1]
-            except Exception as e:
-                files = {}
-            con.close()
-            total_files[type] = files
+        total_files = {type: {} for type in file_types}
+        metadata = {type: {} for type in file_types}
+        con = get_connection(os.path.join('data', 'studies.db'))
+        cursor = con.cursor()
+        cursor.row_factory = sqlite3.Row # by column name, the connection is shared by the thread
+        rows = cursor.execute('SELECT * FROM catalog WHERE study_id = ? ORDER BY type, file_id', (studyID,)).fetchall()
+        for row in rows:
+            if row['type'] in total_files:
+                total_files[row['type']][row['file_id']] = row['name']
+                metadata[row['type']][row['file_id']] = {key: row[key] for key in row.keys() if key not in ['study_id', 'type', 'file_id', 'file_path']}
         
         # Return the files
-        return jsonify({'status': 'success', 'types':file_types, 'files':total_files})
+        return jsonify({'status': 'success', 'types':file_types, 'files':total_files, 'metadata':metadata})
     
     except Exception as e:
         # Return the error
@@ -507,77 +2056,42 @@ def study_modify(studyID):
         logger.info(f'Cannot modify, no study with ID {studyID}.')
         return jsonify({'status':'unexisting'})
     
-    # Save the old data
-    old_name = studies[studyID]['name']
-    old_desc = studies[studyID]['desc']
-    old_lat = studies[studyID]['lat']
-    old_lon = studies[studyID]['lon']
-    
     try:
         # Get the form data
         name = request.form.get('studyName')
         desc = request.form.get('studyDesc')
-        lat = request.form.get('studyLat')
-        lon = request.form.get('studyLon')
-        
-        # Modify the study in the dictionnary
-        studies[studyID]['name'] = name
-        studies[studyID]['desc'] = desc
-        studies[studyID]['lat'] = lat
-        studies[studyID]['lon'] = lon
-        
-        # Modify the study in the database
-        studies_db_path = os.path.join('data', 'studies.db')
-        con = sqlite3.connect(studies_db_path)
-        cursor = con.cursor()
-        cursor.execute(f'''
-            UPDATE studies
-            SET name = ?,
-                desc = ?,
-                lat = ?,
-                lon = ?
-            WHERE id = {studyID}
-        ''', (
-            name,
-            desc,
-            lat,
-            lon
-        ))
-        con.commit()
-        con.close()
+        lat = float(request.form.get('studyLat'))
+        lon = float(request.form.get('studyLon'))
+        
+        # Modify the study in the database and the dictionnary
+        with studies_transaction() as con:
+            con.execute('''
+                UPDATE studies
+                SET name = ?,
+                    desc = ?,
+                    lat = ?,
+                    lon = ?
+                WHERE id = ?
+            ''', (
+                name,
+                desc,
+                lat,
+                lon,
+                studyID
+            ))
+            studies[studyID]['name'] = name
+            studies[studyID]['desc'] = desc
+            studies[studyID]['lat'] = lat
+            studies[studyID]['lon'] = lon
+        cluster_study(studyID)
+        invalidate_rendered_maps(studyID)
         
         # Return the success
         logger.info(f'The study with ID {studyID} was modified succesfuly.')
         return jsonify({'status':'success'})
     
     except Exception as e:
-        # Put back the data in the dictionnary
-        studies[studyID]['name'] = old_name
-        studies[studyID]['desc'] = old_desc
-        studies[studyID]['lat'] = old_lat
-        studies[studyID]['lon'] = old_lon
-        
-        # Put back the data in the database
-        studies_db_path = os.path.join('data', 'studies.db')
-        con = sqlite3.connect(studies_db_path)
-        cursor = con.cursor()
-        cursor.execute(f'''
-            UPDATE studies
-            SET name = ?,
-                desc = ?,
-                lat = ?,
-                lon = ?
-            WHERE id = {studyID}
-        ''', (
-            old_name,
-            old_desc,
-            old_lat,
-            old_lon
-        ))
-        con.commit()
-        con.close()
-        
-        # Return the error
+        # Return the error, the database and the dictionnary are unchanged
         logger.error(f'An error has occured while trying to modify the study with ID {studyID}: {e}.')
         return jsonify({'status':'error'})
 
@@ -593,25 +2107,18 @@ def study_visibility(studyID):
         return jsonify({'status':'unexisting'})
     
     try:
-        new_state = not(studies[studyID]['visibility'])
-        
-        # Change in the database
-        studies_db_path = os.path.join('data', 'studies.db')
-        con = sqlite3.connect(studies_db_path)
-        cursor = con.cursor()
-        cursor.execute('''
-            UPDATE studies
-            SET visibility = ?
-            WHERE id = ?
-        ''', (
-            new_state,
-            studyID
-        ))
-        con.commit()
-        con.close()
-        
-        # Change in the dictionnary
-        studies[studyID]['visibility'] = new_state
+        # Change in the database and the dictionnary, from the state in the database
+        with studies_transaction() as con:
+            new_state = not(con.execute('SELECT visibility FROM studies WHERE id = ?', (studyID,)).fetchone()[0] == 1)
+            con.execute('''
+                UPDATE studies
+                SET visibility = ?
+                WHERE id = ?
+            ''', (
+                new_state,
+                studyID
+            ))
+            studies[studyID]['visibility'] = new_state
         
         # Return the success
         return jsonify({'status':'success', 'visibility':new_state})
@@ -633,23 +2140,29 @@ def study_delete(studyID):
         logger.info(f'Cannot delete, no study with ID {studyID}.')
         return jsonify({'status':'unexisting'})
     
-    # Delete from the database
-    studies_db_path = os.path.join('data', 'studies.db')
-    con = sqlite3.connect(studies_db_path)
-    cursor = con.cursor()
-    cursor.execute(f'''
-        DELETE FROM studies
-        WHERE id = {studyID}
-    ''')
-    con.commit()
-    con.close()
-    
-    # Delete the folder
+    # Delete from the database, the catalog and the dictionnary
     dir_path = studies[studyID]['dir_path']
-    shutil.rmtree(dir_path)
+    with studies_transaction() as con:
+        con.execute('DELETE FROM studies WHERE id = ?', (studyID,))
+        con.execute('DELETE FROM catalog WHERE study_id = ?', (studyID,))
+        studies.pop(studyID)
+    with study_clusters_lock:
+        uncluster_study(studyID)
+    invalidate_rendered_maps(studyID)
+    
+    # Cancel the jobs of the study
+    with jobs_lock:
+        study_jobs = [jobID for jobID, job in jobs.items() if job['study'] == studyID]
+    for jobID in study_jobs:
+        cancel_job(jobID)
     
-    # Delete from the dictionnary
-    studies.pop(studyID)
+    # Delete the folder and the staged files
+    close_connections(os.path.join(dir_path, 'files.db'))
+    shutil.rmtree(dir_path)
+    with staged_files_lock:
+        study_tokens = [token for token, staged in staged_files.items() if staged['study'] == studyID]
+    for token in study_tokens:
+        release_staged_file(token)
 
     # Return the success
     logger.info(f'The study with ID {studyID} has been deleted successfuly.')
@@ -671,7 +2184,6 @@ def study_add_file_subdiv_preprocess(studyID):
     if studyID not in studies:
         logger.info(f'No existing data for the study with ID {studyID}.')
         return jsonify({'status':'unexisting'})
-    dir_path = studies[studyID]['dir_path']
     
     # Get the form data
     try:
@@ -682,69 +2194,31 @@ def study_add_file_subdiv_preprocess(studyID):
         logger.error(f'An error has occured while getting the request: {e}.')
         return jsonify({'status':'error'})
     
-    # Download the shapefile
-    try:
-        # Download the zipfile
-        temp_zip = os.path.join(dir_path, 'temp', 'subdiv.zip')
-        subdiv_file.save(temp_zip)
-        # Unzip it
-        temp_folder = os.path.join(dir_path, 'temp', 'subdiv')
-        with zipfile.ZipFile(temp_zip, 'r') as zip_file:
-            zip_file.extractall(temp_folder)
-        # Take the files only, and not the potential folder with the files within
-        if len([f for f in os.listdir(temp_folder) if f.endswith('.shp')]) == 0:
-            temp_file_folder = os.path.join(temp_folder, os.listdir(temp_folder)[0])
-        else:
-            temp_file_folder = temp_folder
-        
-    except Exception as e:
-        # Remove the temps
-        os.remove(temp_zip)
-        shutil.rmtree(temp_folder)
-        # Return the error
-        logger.error(f'An error has occured while trying to download the file: {e}.')
-        return jsonify({'status':'error'})
-    
     # Read the columns headers
+    token = None
     try:
-        # Get the different files
-        shp_files = [f for f in os.listdir(temp_file_folder) if f.endswith('.shp')]
-        shx_files = [f for f in os.listdir(temp_file_folder) if f.endswith('.shx')]
-        dbf_files = [f for f in os.listdir(temp_file_folder) if f.endswith('.dbf')]
-        
-        # Check if the folder as a single shapefile and the mandatory files
-        count = len(shp_files) + len(shx_files) + len(dbf_files)
-        nb_mandatory_files = 3 # shp, shx and dbf
-        if count > nb_mandatory_files:
-            raise Exception('There are multiple shapefiles within the zipfile.')
-        elif count < nb_mandatory_files:
-            raise Exception('The shapefile is incomplete.')
-        
-        # Read the file
-        shapefile = os.path.join(temp_file_folder, shp_files[0])
-        data_subdiv = gpd.read_file(shapefile)
-        data_subdiv.to_crs(epsg=4326, inplace=True)
+        # Check the zipfile, then stage it for the process step
+        with stage_timer('stage'):
+            shapefile_zip = open_shapefile_zip(subdiv_file.stream)
+            shapefile_zip['zip'].close()
+            token = stage_file(studyID, subdiv_file)
         
-        # Get the columns headers
-        columns = list(data_subdiv.columns)
-        
-        # Remove the temps
-        os.remove(temp_zip)
-        shutil.rmtree(temp_folder)
+        # Read the schema only, from the staged zipfile
+        with stage_timer('read'):
+            schema = read_staged_schema(studyID, token)
         
         # Return the success
-        return jsonify({'status':'success', 'columns': columns})
+        return jsonify({'status':'success', 'columns': schema['columns'], 'types': schema['types'], 'count': schema['count'], 'crs': schema['crs'], 'fileToken': token})
         
     except Exception as e:
-        # Remove the temps
-        os.remove(temp_zip)
-        shutil.rmtree(temp_folder)
         # Return the error
         logger.error(f'An error has occured while pre-processing the file: {e}.')
+        if token is not None:
+            release_staged_file(token)
         return jsonify({'status':'badfile', 'message': e.args})
 
 
-# Subdivision in zones - Process
+# Subdivision in zones - Process, in a job
 @app.route('/study/<studyID>/add_file/subdiv/process', methods=['POST'])
 def study_add_file_subdiv_process(studyID):
     studyID = int(studyID)
@@ -759,6 +2233,7 @@ def study_add_file_subdiv_process(studyID):
     # Get the form data
     try:
         subdiv_file = request.files.get('fileFile')
+        file_token = request.form.get('fileToken')
         file_name = request.form.get('fileName')
         headers = request.form.get('fileHeaders')
         headers = json.loads(headers)
@@ -768,190 +2243,268 @@ def study_add_file_subdiv_process(studyID):
         logger.error(f'An error has occured while getting the request: {e}.')
         return jsonify({'status':'error'})
     
-    # Download the shapefile
+    # Get the zipfile staged by the pre-process, or stage the uploaded one
     try:
-        # Download the zipfile
-        temp_zip = os.path.join(dir_path, 'temp', 'subdiv.zip')
-        subdiv_file.save(temp_zip)
-        # Unzip it
-        temp_folder = os.path.join(dir_path, 'temp', 'subdiv')
-        with zipfile.ZipFile(temp_zip, 'r') as zip_file:
-            zip_file.extractall(temp_folder)
-        # Take the files only, and not the potential folder with the files within
-        if len([f for f in os.listdir(temp_folder) if f.endswith('.shp')]) == 0:
-            temp_file_folder = os.path.join(temp_folder, os.listdir(temp_folder)[0])
-        else:
-            temp_file_folder = temp_folder
-    
+        with stage_timer('stage'):
+            if file_token:
+                source = get_staged_file(studyID, file_token)
+            else:
+                file_token = stage_file(studyID, subdiv_file)
+                source = get_staged_file(studyID, file_token)
+        if source is None:
+            logger.info(f'The staged file {file_token} of the study with ID {studyID} has expired.')
+            return jsonify({'status':'expired'})
+        batch_size, extension = staged_ingestion_mode(source)
+        
     except Exception as e:
-        # Remove the temps
-        os.remove(temp_zip)
-        shutil.rmtree(temp_folder)
         # Return the error
-        logger.error(f'An error has occured while trying to download the file: {e}.')
+        logger.error(f'An error has occured while staging the file: {e}.')
         return jsonify({'status':'error'})
     
-    # Read the file
-    try:
-        # Get the different files
-        shp_files = [f for f in os.listdir(temp_file_folder) if f.endswith('.shp')]
-        shx_files = [f for f in os.listdir(temp_file_folder) if f.endswith('.shx')]
-        dbf_files = [f for f in os.listdir(temp_file_folder) if f.endswith('.dbf')]
-        
-        # Check if the folder as a single shapefile and the mandatory files
-        count = len(shp_files) + len(shx_files) + len(dbf_files)
-        nb_mandatory_files = 3 # shp, shx and dbf
-        if count > nb_mandatory_files:
-            raise Exception('There are multiple shapefiles within the zipfile.')
-        elif count < nb_mandatory_files:
-            raise Exception('The shapefile is incomplete.')
-        
-        # Read the file
-        shapefile = os.path.join(temp_file_folder, shp_files[0])
-        data_subdiv = gpd.read_file(shapefile)
-        data_subdiv.to_crs(epsg=4326, inplace=True)
-        
-        # Remove the temps
-        os.remove(temp_zip)
-        shutil.rmtree(temp_folder)
-        
-        # Keep the good columns
-        data_subdiv = data_subdiv[[
-            str(headers['Geometry']),
-            str(headers['Subzone ID']),
-            str(headers['Subzone name'])
-        ]]
-        
-        # Rename the columns
-        data_subdiv.rename(columns={
-            str(headers['Geometry']): 'geometry',
-            str(headers['Subzone ID']): 'old_zone_id',
-            str(headers['Subzone name']): 'old_zone_name'
-        }, inplace=True)
+    # Register the file once it is read, cleaned and saved
+    temporary_path = os.path.join(dir_path, 'temp', 'jobs', uuid.uuid4().hex + extension)
+    def finalize(outcomes):
+        result = task_result(outcomes[0])
+        if studyID not in studies:
+            raise Exception(f'The study with ID {studyID} was deleted.')
         
-        # Clean the dataset
-        data_subdiv['zone_id'] = -1
-        data_subdiv['zone_name'] = ''
-        data_subdiv['clean'] = True
+        # Add the file to the database
+        start = time.perf_counter()
+        con = get_connection(os.path.join(dir_path, 'files.db'))
+        with transaction(con):
+            fileID = con.execute('''
+                INSERT INTO subdiv (
+                    name
+                ) VALUES (?)
+            ''', (
+                str(file_name),
+            )).lastrowid
+            fileID = int(fileID)
+            subdiv_path = os.path.join(dir_path, 'subdiv')
+            file_path = os.path.join(subdiv_path, f'{fileID} - {file_name}{extension}')
+            con.execute('''
+                UPDATE subdiv
+                SET file_path = ?
+                WHERE id = ?
+            ''', (
+                file_path,
+                fileID
+            ))
         
-        clean_ids = []
-        
-        for index, row in data_subdiv.iterrows():
+        # Move the file to the subdiv folder and register it in the catalog
+        try:
+            os.makedirs(subdiv_path, exist_ok=True)
+            os.replace(temporary_path, file_path)
+            catalog_file(get_connection(os.path.join('data', 'studies.db')), studyID, 'subdiv', fileID, str(file_name), file_path, result['metadata'])
             
-            # Clean the id
-            float_id = float(str(row['old_zone_id']))
-            if float_id % 1 == 0:
-                data_subdiv.loc[index, 'zone_id'] = int(float_id)
-                clean_ids.append(int(float_id))
-            else:
-                data_subdiv.loc[index, 'clean'] = False
-                
-            # Clean the name
-            name = row['old_zone_name']
-            if type(name) is str:
-                data_subdiv.loc[index, 'zone_name'] = name
-            else:
-                data_subdiv.loc[index, 'clean'] = False
+        except Exception as e:
+            # Delete from the db
+            con.execute('DELETE FROM subdiv WHERE id = ?', (fileID,))
+            # Delete the file
+            if os.path.exists(file_path):
+                os.remove(file_path)
+            raise
         
-        # Check for unique ids
-        if len(clean_ids) == 0:
-            raise Exception('There are no id that are integers.')
-        elif len(clean_ids) != len(set(clean_ids)) :
-            raise Exception('The file does not contain unique ids.')
+        # A staged file is kept until it is processed succesfuly
+        release_staged_file(file_token)
+        timings = dict(result['timings'], register=time.perf_counter() - start)
         
-        # Keep the good columns
-        data_subdiv = data_subdiv[['clean', 'geometry', 'zone_id', 'zone_name']]
-        
-    except Exception as e:
-        # Remove the temps
-        os.remove(temp_zip)
-        shutil.rmtree(temp_folder)
-        # Return the error
-        logger.error(f'An error has occured while reading the file: {e}.')
-        return jsonify({'status':'badfile', 'message': e.args})
+        logger.info(f'The file "{file_name}" was created succesfuly.')
+        logger.info(f'Ingestion of the file "{file_name}" ({result["count"]} zones): ' + ', '.join(f'{stage} {duration:.3f}s' for stage, duration in timings.items()) + '.')
+        logger.info(f'Simplification levels of the file "{file_name}": ' + ', '.join(f'{level} {report["vertices"]} vertices {report["bytes"]} bytes' for level, report in result['levels'].items()) + '.')
+        return {'fileID': fileID, 'timings': timings, 'levels': result['levels'], 'metadata': result['metadata']}
+    
+    # Read, reproject, clean and save the file in a job
+    os.makedirs(os.path.dirname(temporary_path), exist_ok=True)
+    with stage_timer('submit'):
+        jobID = submit_job('subdiv', studyID, [(ingest_subdiv, (source, headers, temporary_path, batch_size))], finalize, temporary_files=[temporary_path])
+    if jobID is None:
+        logger.info(f'Cannot process the file for the study with ID {studyID}, too many jobs are pending.')
+        return jsonify({'status':'busy', 'fileToken':file_token})
+    
+    # Return the job, its result gives the ID of the file
+    return jsonify({'status':'success', 'jobID':jobID, 'fileToken':file_token})
+
+
+# Subdivisions in zones - Pre-process of several zipfiles, each shapefile of a zipfile is staged on its own
+@app.route('/study/<studyID>/add_file/subdiv/preprocess_batch', methods=['POST'])
+def study_add_file_subdiv_preprocess_batch(studyID):
+    studyID = int(studyID)
+    
+    # Check if the study exists
+    global studies
+    if studyID not in studies:
+        logger.info(f'No existing data for the study with ID {studyID}.')
+        return jsonify({'status':'unexisting'})
     
-    # Add the file to the database 1/2
+    # Get the form data
     try:
-        study_db_path = os.path.join(dir_path, 'files.db')
-        con = sqlite3.connect(study_db_path)
-        cursor = con.cursor()
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS subdiv (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT,
-                file_path TEXT
-            )
-        ''')
-        con.commit()
-        cursor.execute('''
-            INSERT INTO subdiv (
-                name
-            ) VALUES (?)
-        ''', (
-            str(file_name),
-        ))
-        con.commit()
+        subdiv_files = request.files.getlist('fileFiles')
         
     except Exception as e:
         # Return the error
-        con.close()
-        logger.error(f'An error has occured while trying to add the file to the database 1/2: {e}.')
+        logger.error(f'An error has occured while getting the request: {e}.')
         return jsonify({'status':'error'})
     
-    # Get the id
-    fileID = cursor.lastrowid
-    fileID = int(fileID)
+    # Read the columns headers of each shapefile
+    files = []
+    for subdiv_file in subdiv_files:
+        try:
+            with stage_timer('stage'):
+                shapefiles = stage_shapefiles(studyID, subdiv_file)
+            for staged in shapefiles:
+                schema = staged['schema']
+                files.append({'status':'success', 'file': subdiv_file.filename, 'shapefile': staged['shapefile'], 'columns': schema['columns'], 'types': schema['types'], 'count': schema['count'], 'crs': schema['crs'], 'fileToken': staged['token']})
+            
+        except Exception as e:
+            logger.error(f'An error has occured while pre-processing the file {subdiv_file.filename}: {e}.')
+            files.append({'status':'badfile', 'file': subdiv_file.filename, 'message': e.args})
     
-    # Save the file
-    try: 
-        # Create the subdiv folder
-        subdiv_path = os.path.join(dir_path, 'subdiv')
-        os.makedirs(subdiv_path, exist_ok=True)
-        
-        # Save the geo dataframe
-        file_path = os.path.join(subdiv_path, f'{fileID} - {file_name}.gpkg')
-        data_subdiv.to_file(file_path, driver='GPKG')
-        
-    except Exception as e:
-        # Return the error
-        con.close()
-        logger.error(f'An error has occured while trying to save the file as geopackage: {e}.')
-        return jsonify({'status':'error'})
+    # Return the shapefiles
+    return jsonify({'status':'success', 'files':files})
+
+
+# Subdivisions in zones - Process of several files in a job, they are ingested in parallel and registered together.
+# Each file of fileBatch has its fileName and fileHeaders, and either the fileToken of the pre-process or the fileIndex
+# of its zipfile in fileFiles, with its shapefile when the zipfile has several.
+@app.route('/study/<studyID>/add_file/subdiv/process_batch', methods=['POST'])
+def study_add_file_subdiv_process_batch(studyID):
+    studyID = int(studyID)
+    
+    # Check if the study exists
+    global studies
+    if studyID not in studies:
+        logger.info(f'No existing data for the study with ID {studyID}.')
+        return jsonify({'status':'unexisting'})
+    dir_path = studies[studyID]['dir_path']
     
-    # Add the file to the database 2/2
+    # Get the form data
     try:
-        cursor.execute('''
-            UPDATE subdiv
-            SET file_path = ?
-            WHERE id = ?
-        ''', (
-            file_path,
-            fileID
-        ))
-        con.commit()
+        subdiv_files = request.files.getlist('fileFiles')
+        batch = json.loads(request.form.get('fileBatch'))
+        if not isinstance(batch, list):
+            raise Exception('The batch is not a list of files.')
         
     except Exception as e:
-        # Delete from the db
-        cursor.execute(f'''
-            DELETE FROM subdiv
-            WHERE id = {fileID}
-        ''')
-        con.commit()
-        con.close()
-        # Delete the directory
-        os.remove(file_path)
         # Return the error
-        logger.error(f'An error has occured while trying to add the file to the database 2/2: {e}.')
+        logger.error(f'An error has occured while getting the request: {e}.')
         return jsonify({'status':'error'})
     
-    # Return the success
-    con.close()
-    logger.info(f'The file "{file_name}" was created succesfuly.')
-    return jsonify({'status':'success', 'fileID': fileID})
+    # Stage the uploaded zipfiles, by index and shapefile
+    uploads = {}
+    for i, subdiv_file in enumerate(subdiv_files):
+        try:
+            with stage_timer('stage'):
+                uploads[i] = {staged['shapefile']: staged['token'] for staged in stage_shapefiles(studyID, subdiv_file)}
+        except Exception as e:
+            logger.error(f'An error has occured while reading the file {subdiv_file.filename}: {e}.')
+            uploads[i] = e
+    
+    # Get the staged zipfile of each file of the batch
+    results = [None] * len(batch)
+    tasks = []
+    runs = [] # file and temporary path of each task
+    for i, entry in enumerate(batch):
+        file_name = entry.get('fileName') if isinstance(entry, dict) else None
+        try:
+            if not isinstance(entry, dict):
+                raise Exception('The file of the batch is not an object.')
+            file_headers = entry['fileHeaders']
+            file_token = entry.get('fileToken')
+            if file_token is None:
+                upload = uploads[int(entry['fileIndex'])]
+                if isinstance(upload, Exception):
+                    raise upload
+                if entry.get('shapefile') is None and len(upload) > 1:
+                    raise Exception('The zipfile has several shapefiles, one must be given.')
+                file_token = upload[entry['shapefile']] if entry.get('shapefile') is not None else next(iter(upload.values()))
+            source = get_staged_file(studyID, file_token)
+            if source is None:
+                results[i] = {'fileName': file_name, 'status': 'expired'}
+                continue
+            batch_size, extension = staged_ingestion_mode(source)
+            
+        except Exception as e:
+            results[i] = {'fileName': file_name, 'status': 'badfile', 'message': e.args}
+            continue
+        
+        temporary_path = os.path.join(dir_path, 'temp', 'jobs', uuid.uuid4().hex + extension)
+        tasks.append((ingest_subdiv, (source, file_headers, temporary_path, batch_size)))
+        runs.append({'file': i, 'name': file_name, 'token': file_token, 'path': temporary_path, 'extension': extension})
+    
+    if len(tasks) == 0:
+        logger.info(f'No file of the batch for the study with ID {studyID} can be processed.')
+        return jsonify({'status':'error', 'files':results})
+    
+    # Register the files that were read, cleaned and saved, in a single transaction
+    files = list(results)
+    def finalize(outcomes):
+        if studyID not in studies:
+            raise Exception(f'The study with ID {studyID} was deleted.')
+        start = time.perf_counter()
+        
+        # Files that failed
+        for run, outcome in zip(runs, outcomes):
+            if 'exception' in outcome:
+                status = 'badfile' if outcome['badfile'] else 'error'
+                logger.error(f'An error has occured while processing the file "{run["name"]}": {outcome["exception"]}.')
+                results[run['file']] = {'fileName': run['name'], 'status': status, 'message': outcome['exception'].args, 'fileToken': run['token']}
+        succeeded = [(run, outcome['result']) for run, outcome in zip(runs, outcomes) if 'result' in outcome]
+        
+        # Add the files to the database and move them to the subdiv folder
+        con = get_connection(os.path.join(dir_path, 'files.db'))
+        subdiv_path = os.path.join(dir_path, 'subdiv')
+        moved = []
+        try:
+            with transaction(con):
+                registered = []
+                for run, result in succeeded:
+                    fileID = int(con.execute('INSERT INTO subdiv (name) VALUES (?)', (str(run['name']),)).lastrowid)
+                    file_path = os.path.join(subdiv_path, f'{fileID} - {run["name"]}{run["extension"]}')
+                    con.execute('UPDATE subdiv SET file_path = ? WHERE id = ?', (file_path, fileID))
+                    registered.append((run, result, fileID, file_path))
+                
+                os.makedirs(subdiv_path, exist_ok=True)
+                for run, result, fileID, file_path in registered:
+                    os.replace(run['path'], file_path)
+                    moved.append(file_path)
+                
+                # Register the files in the catalog
+                catalog_con = get_connection(os.path.join('data', 'studies.db'))
+                with transaction(catalog_con):
+                    for run, result, fileID, file_path in registered:
+                        catalog_file(catalog_con, studyID, 'subdiv', fileID, str(run['name']), file_path, result['metadata'])
+            
+        except Exception as e:
+            # Delete the files, the database is unchanged
+            for file_path in moved:
+                os.remove(file_path)
+            raise
+        
+        # Files that succeeded, their staged files are released
+        register = time.perf_counter() - start
+        for run, result, fileID, file_path in registered:
+            release_staged_file(run['token'])
+            timings = dict(result['timings'], register=register)
+            results[run['file']] = {'fileName': run['name'], 'status': 'success', 'fileID': fileID, 'timings': timings, 'levels': result['levels'], 'metadata': result['metadata']}
+            logger.info(f'Ingestion of the file "{run["name"]}" ({result["count"]} zones): ' + ', '.join(f'{stage} {duration:.3f}s' for stage, duration in timings.items()) + '.')
+        logger.info(f'{len(registered)} of the {len(batch)} files of the batch were created succesfuly for the study with ID {studyID}.')
+        return {'files': results}
+    
+    # Ingest the files in parallel in a job
+    os.makedirs(os.path.join(dir_path, 'temp', 'jobs'), exist_ok=True)
+    with stage_timer('submit'):
+        jobID = submit_job('subdiv_batch', studyID, tasks, finalize, temporary_files=[run['path'] for run in runs])
+    if jobID is None:
+        logger.info(f'Cannot process the batch for the study with ID {studyID}, too many jobs are pending.')
+        return jsonify({'status':'busy', 'files':files})
+    
+    # Return the job, its result gives the result of each file
+    return jsonify({'status':'success', 'jobID':jobID, 'files':files})
 
 
-# View the file
-@app.route('/study/<studyID>/subdiv/<fileID>', methods=['POST'])
+# View the file. With GET, each parameter is a JSON value in the query string, so that the map can be kept by the browser.
+@app.route('/study/<studyID>/subdiv/<fileID>', methods=['GET', 'POST'])
 def study_subdiv(studyID, fileID):
     studyID = int(studyID)
     fileID = int(fileID)
@@ -966,16 +2519,11 @@ def study_subdiv(studyID, fileID):
         # Get the path in the database
         dir_path = studies[studyID]['dir_path']
         db_path = os.path.join(dir_path, 'files.db')
-        con = sqlite3.connect(db_path)
-        cursor = con.cursor()
-        for row in cursor.execute(f'SELECT * FROM subdiv WHERE id = {fileID}'):
+        con = get_connection(db_path)
+        for row in con.execute('SELECT * FROM subdiv WHERE id = ?', (fileID,)):
             file_name = row[1]
             file_path = row[2]
-        con.close()
-        
-        # Open the file
-        data_subdiv = gpd.read_file(file_path)
-        data_subdiv.to_crs(epsg=4326, inplace=True)
+        file_stat = os.stat(file_path)
         
     except Exception as e:
         logger.info(f'Either the file of type subdiv with ID {fileID} or the study with ID {studyID} does not exist.')
@@ -983,72 +2531,232 @@ def study_subdiv(studyID, fileID):
     
     try:
         # Get the request
-        data = json.loads(request.get_data())
+        if request.method == 'GET':
+            data = {key: json.loads(value) for key, value in request.args.items()}
+        else:
+            data = json.loads(request.get_data())
         first_map = data['first_map']
+        client_selection = data.get('client_selection', False) # the selection is then done in the map by selectZone
+        compact = data.get('compact', False) # compact transport of the geometries
+        viewport = data.get('viewport', False) # only the zones seen, the others are loaded when the map moves
         
         if first_map:
             coord = [studies[studyID]['lat'], studies[studyID]['lon']]
             zoom = 10 # default folium zoom
             selected = -1
+        elif client_selection:
+            # Requested again when the zoom changes of simplification level
+            center = data.get('center', {'lat': studies[studyID]['lat'], 'lng': studies[studyID]['lon']})
+            coord = [center['lat'], center['lng']]
+            zoom = data.get('zoom', 10)
+            selected = -1
         else:
             center = data['center']
             coord = [center['lat'], center['lng']]
             zoom = data['zoom']
             selected = int(str(data['selected']))
         
+        # Bounding box of the zones seen in the viewport
+        bbox = tuple(viewport_bbox(coord, zoom, **data.get('size', {}))) if viewport else None
+        
     except Exception as e:
         logger.error(f'An error has occured while getting the request: {e}.')
         return jsonify({'status': 'error'})
     
+    # Not modified since the version of the file the client has
+    etag = response_etag(('study_subdiv', studyID, fileID, file_path, file_stat.st_mtime_ns, file_stat.st_size, file_name, coord, zoom, selected, client_selection, compact, viewport, data.get('size')))
+    response = not_modified(etag)
+    if response is not None:
+        return response
+    
+    # The maps without selection are the same for every request, so they are cached
+    cacheable = first_map or client_selection
+    if cacheable:
+        key = ('study_subdiv', studyID, fileID, file_stat.st_mtime_ns, file_stat.st_size, coord[0], coord[1], zoom, client_selection, compact, bbox)
+        with stage_timer('cache'):
+            response = get_rendered_map(key)
+        if response is not None:
+            return etag_response(app.response_class(response, mimetype='application/json'), etag)
+    
     try:
+        # Open the file at the simplification level of the zoom, within the viewport
+        with stage_timer('read'):
+            if viewport:
+                data_subdiv, level = read_simplified_level(file_path, zoom, bbox=list(bbox), columns=['zone_id', 'zone_name', 'clean'])
+            else:
+                data_subdiv, level = read_simplified_level(file_path, zoom, columns=['zone_id', 'zone_name', 'clean'])
+        with stage_timer('reproject'):
+            data_subdiv.to_crs(epsg=4326, inplace=True)
         
-        # Create the map
-        map = folium.Map(location=coord, zoom_start=zoom)
-        map_name = map.get_name()
-        
-        # Display the zones
-        zones_clean = {}
-        zones_unclean = {}
-        for _, zone in data_subdiv.iterrows():
-            if zone['clean'] == True:
+        with stage_timer('render'):
+            # Create the map
+            map = folium.Map(location=coord, zoom_start=zoom)
+            map_name = map.get_name()
             
-                # Put in color if the zone is selected
-                if zone['zone_id'] == selected:
-                    color = 'red'
-                else:
-                    color = False
-                
-                # Plot geometries
-                if zone['geometry'].geom_type == 'Polygon':
-                    poly = folium_subdiv(zone['geometry'], colorfill=color, text=zone['zone_name'])
-                    poly.add_to(map)
-                    poly_names = [poly.get_name()]
-                elif zone['geometry'].geom_type == 'MultiPolygon':
-                    poly_names = []
-                    for subzone in list(zone['geometry'].geoms):
-                        poly = folium_subdiv(subzone, colorfill=color, text=zone['zone_name'])
-                        poly.add_to(map)
-                        poly_names.append(poly.get_name())
-                        
-                # Zones dict data clean
-                zones_clean[zone['zone_id']] = {}
-                zones_clean[zone['zone_id']]['geometry'] = poly_names
-                zones_clean[zone['zone_id']]['name'] = zone['zone_name']
+            # Display the clean zones, the selected one is in color
+            clean = data_subdiv['clean'] == True
+            data_clean = data_subdiv[clean]
+            zone_ids = data_clean['zone_id'].tolist()
+            zone_names = data_clean['zone_name'].tolist()
+            selection = (data_clean['zone_id'] == selected).to_numpy()
+            layer = folium_zones(
+                data_clean.geometry.values,
+                zone_ids,
+                texts=zone_names,
+                fill_colors=np.where(selection, 'red', 'black').tolist(),
+                fill_opacities=np.where(selection, 0.3, 0).tolist(),
+                compact=compact,
+                precision=quantization_precision(level)
+            )
+            layer.add_to(map)
+            layer_name = layer.get_name()
             
-            else:
-                # Zones dict data unclean
-                zones_unclean[zone['zone_id']] = {}
-                zones_unclean[zone['zone_id']]['name'] = zone['zone_name']     
-
-        iframe = map.get_root()._repr_html_()
-        iframe = iframe.replace('<iframe ', '<iframe id="mapDisplay" ')
-        return jsonify({'status':'success', 'fileName':file_name, 'iframe':str(iframe), 'mapName': map_name, 'zonesClean': zones_clean, 'zonesUnclean': zones_unclean})
+            # Zones dict data, the geometry of a clean zone is the feature with its id in the layer
+            zones_clean = {zone_id: {'geometry': [layer_name], 'name': zone_name} for zone_id, zone_name in zip(zone_ids, zone_names)}
+            zones_unclean = {zone_id: {'name': zone_name} for zone_id, zone_name in zip(data_subdiv.loc[~clean, 'zone_id'].tolist(), data_subdiv.loc[~clean, 'zone_name'].tolist())}
+            
+            # Selection of the zones within the map
+            if client_selection:
+                folium_subdiv_selection(layer).add_to(map)
+            
+            # Loading of the zones when the map moves
+            if viewport:
+                url = url_for('study_subdiv_viewport', studyID=studyID, fileID=fileID)
+                folium_subdiv_viewport(layer, url, bbox, zoom, compact=compact).add_to(map)
+        count_features(len(zone_ids))
+        
+        with stage_timer('serialize'):
+            iframe = map.get_root()._repr_html_()
+            iframe = iframe.replace('<iframe ', '<iframe id="mapDisplay" ')
+        response = {'status':'success', 'fileName':file_name, 'iframe':str(iframe), 'mapName': map_name, 'layerName': layer_name, 'level': level, 'zonesClean': zones_clean, 'zonesUnclean': zones_unclean}
+        
+        # Cache the response
+        with stage_timer('jsonify'):
+            if cacheable:
+                response = app.json.dumps(response)
+                cache_rendered_map(key, response)
+                return etag_response(app.response_class(response, mimetype='application/json'), etag)
+            return etag_response(jsonify(response), etag)
             
     except Exception as e:
         logger.error(f'Cannot access the file of type subdiv with ID {fileID} for the study with ID {studyID}.')
         return jsonify({'status': 'error'})
 
 
+# Zones of the file seen in a viewport, without the ones already loaded in the previous one
+@app.route('/study/<studyID>/subdiv/<fileID>/viewport', methods=['POST'])
+def study_subdiv_viewport(studyID, fileID):
+    studyID = int(studyID)
+    fileID = int(fileID)
+    
+    # Check if the study exists
+    global studies
+    if studyID not in studies:
+        logger.info(f'No existing data for the study with ID {studyID}.')
+        return jsonify({'status':'unexisting'})
+    
+    try:
+        # Get the path in the database
+        dir_path = studies[studyID]['dir_path']
+        db_path = os.path.join(dir_path, 'files.db')
+        con = get_connection(db_path)
+        file_path = con.execute('SELECT file_path FROM subdiv WHERE id = ?', (fileID,)).fetchone()[0]
+        
+    except Exception as e:
+        logger.info(f'Either the file of type subdiv with ID {fileID} or the study with ID {studyID} does not exist.')
+        return jsonify({'status': 'unexisting'})
+    
+    try:
+        # Get the request, the bounding boxes are [south, west, north, east]
+        data = json.loads(request.get_data())
+        bbox = [float(value) for value in data['bbox']]
+        previous = data.get('previous')
+        zoom = data['zoom']
+        compact = data.get('compact', False)
+        
+    except Exception as e:
+        logger.error(f'An error has occured while getting the request: {e}.')
+        return jsonify({'status': 'error'})
+    
+    try:
+        # Read the clean zones within the viewport
+        with stage_timer('read'):
+            data_subdiv, level = read_simplified_level(file_path, zoom, bbox=bbox, columns=['zone_id', 'zone_name', 'clean'])
+        with stage_timer('reproject'):
+            data_subdiv.to_crs(epsg=4326, inplace=True)
+        data_subdiv = data_subdiv[data_subdiv['clean'] == True]
+        
+        # Remove the zones already loaded
+        if previous is not None:
+            south, west, north, east = [float(value) for value in previous]
+            data_subdiv = data_subdiv[~data_subdiv.intersects(shapely.box(west, south, east, north))]
+        
+        # Data of the zones
+        with stage_timer('serialize'):
+            zone_ids = data_subdiv['zone_id'].tolist()
+            zone_names = data_subdiv['zone_name'].tolist()
+            zones = app.json.dumps({zone_id: {'name': zone_name} for zone_id, zone_name in zip(zone_ids, zone_names)})
+            data = zones_data(data_subdiv.geometry.values, zone_ids, texts=zone_names, compact=compact, precision=quantization_precision(level))
+        count_features(len(zone_ids))
+        return app.response_class(f'{{"status":"success","level":{json.dumps(level)},"zones":{zones},"data":{data}}}', mimetype='application/json')
+    
+    except Exception as e:
+        logger.error(f'Cannot access the file of type subdiv with ID {fileID} for the study with ID {studyID}: {e}.')
+        return jsonify({'status': 'error'})
+
+
+# Find the zones at points or within a bounding box
+@app.route('/study/<studyID>/subdiv/<fileID>/lookup', methods=['POST'])
+def study_subdiv_lookup(studyID, fileID):
+    studyID = int(studyID)
+    fileID = int(fileID)
+    
+    # Check if the study exists
+    global studies
+    if studyID not in studies:
+        logger.info(f'No existing data for the study with ID {studyID}.')
+        return jsonify({'status':'unexisting'})
+    
+    try:
+        # Get the path in the database
+        dir_path = studies[studyID]['dir_path']
+        db_path = os.path.join(dir_path, 'files.db')
+        con = get_connection(db_path)
+        file_path = con.execute('SELECT file_path FROM subdiv WHERE id = ?', (fileID,)).fetchone()[0]
+        
+        # Get the index
+        with stage_timer('index'):
+            index = get_spatial_index(file_path)
+        
+    except Exception as e:
+        logger.info(f'Either the file of type subdiv with ID {fileID} or the study with ID {studyID} does not exist.')
+        return jsonify({'status': 'unexisting'})
+    
+    try:
+        # Get the request, points as [lat, lon] or a bounding box as [south, west, north, east]
+        data = json.loads(request.get_data())
+        
+        # Zone of each point, None if there is none
+        if 'points' in data:
+            points = np.asarray(data['points'], dtype=float).reshape(-1, 2)
+            points = shapely.points(points[:, 1], points[:, 0])
+            point_index, zone_index = index['tree'].query(points, predicate='intersects')
+            zones = [None] * len(points)
+            for i, j in zip(point_index.tolist()[::-1], zone_index.tolist()[::-1]): # the first zone found is kept
+                zones[i] = indexed_zone(index, j)
+            return jsonify({'status': 'success', 'zones': zones})
+        
+        # Zones intersecting the bounding box
+        south, west, north, east = [float(value) for value in data['bbox']]
+        zone_index = index['tree'].query(shapely.box(west, south, east, north), predicate='intersects')
+        zones = [indexed_zone(index, j) for j in sorted(zone_index.tolist())]
+        return jsonify({'status': 'success', 'zones': zones})
+    
+    except Exception as e:
+        logger.error(f'An error has occured while getting the request: {e}.')
+        return jsonify({'status': 'error'})
+
+
 # Delete the file
 @app.route('/study/<studyID>/subdiv/<fileID>/delete', methods=['POST'])
 def study_subdiv_delete(studyID, fileID):
@@ -1065,15 +2773,14 @@ def study_subdiv_delete(studyID, fileID):
     try:
         dir_path = studies[studyID]['dir_path']
         db_path = os.path.join(dir_path, 'files.db')
-        con = sqlite3.connect(db_path)
-        cursor = con.cursor()
-        result = cursor.execute(f'''
+        con = get_connection(db_path)
+        result = con.execute('''
             SELECT file_path
             FROM subdiv 
-            WHERE id = {fileID}
-        ''').fetchone()
+            WHERE id = ?
+        ''', (fileID,)).fetchone()
         
-        if len(result) == 0:
+        if result is None:
             logger.info(f'Cannot delete, no file of type subdiv with ID {fileID} for study with ID {studyID}.')
             return jsonify({'status':'unexisting'})
         else:
@@ -1084,14 +2791,9 @@ def study_subdiv_delete(studyID, fileID):
         logger.error(f'An error as occured while accessing the database of the study with ID {studyID}.')
         return jsonify({'status': 'error'})
     
-    # Delete from the database
-    print('i am here')
-    cursor.execute(f'''
-        DELETE FROM subdiv
-        WHERE id = {fileID}
-    ''')
-    con.commit()
-    con.close()
+    # Delete from the database and the catalog
+    con.execute('DELETE FROM subdiv WHERE id = ?', (fileID,))
+    get_connection(os.path.join('data', 'studies.db')).execute('DELETE FROM catalog WHERE study_id = ? AND type = ? AND file_id = ?', (studyID, 'subdiv', fileID))
     
     # Delete the file
     os.remove(file_path)
@@ -1099,4 +2801,60 @@ def study_subdiv_delete(studyID, fileID):
     # Return the success
     logger.info(f'The file with ID {fileID} of the study with ID {studyID} has been deleted successfuly.')
     return jsonify({'status':'success'})
-    
\ No newline at end of file
+    
+
+
+#####
+# Commands
+#####
+
+# Convert the stored outlines and files of the studies to a storage format, the files are converted one at a time and
+# the database points to a converted file once it is written. Usage: flask --app app migrate-storage [--to gpkg] [--keep]
+@app.cli.command('migrate-storage')
+@click.option('--to', 'target', type=click.Choice(list(storage_extensions)), default='parquet')
+@click.option('--keep', is_flag=True, help='Keep the files in the former format.')
+def migrate_storage(target, keep):
+    load_studies()
+    extension = storage_extensions[target]
+    catalog_con = get_connection(os.path.join('data', 'studies.db'))
+    converted = 0
+    failed = 0
+    for studyID, study_data in list(studies.items()):
+        dir_path = study_data['dir_path']
+        
+        # Outline
+        for source in [os.path.join(dir_path, 'outline' + other) for other in storage_extensions.values() if other != extension]:
+            destination = os.path.join(dir_path, 'outline' + extension)
+            if not os.path.exists(source) or os.path.exists(destination):
+                continue
+            try:
+                convert_layer(source, destination)
+                if not keep:
+                    os.remove(source)
+                converted += 1
+            except Exception as e:
+                logger.error(f'An error has occured while converting the outline of the study with ID {studyID}: {e}.')
+                failed += 1
+        
+        # Files
+        db_path = os.path.join(dir_path, 'files.db')
+        if not os.path.exists(db_path):
+            continue
+        con = get_connection(db_path)
+        for type in file_types:
+            for fileID, file_path in con.execute(f'SELECT id, file_path FROM {type}').fetchall():
+                if file_path is None or file_path.endswith(extension) or not os.path.exists(file_path):
+                    continue
+                destination = os.path.splitext(file_path)[0] + extension
+                try:
+                    convert_layer(file_path, destination)
+                    con.execute(f'UPDATE {type} SET file_path = ? WHERE id = ?', (destination, fileID))
+                    catalog_con.execute('UPDATE catalog SET file_path = ?, size = ? WHERE study_id = ? AND type = ? AND file_id = ?', (destination, os.path.getsize(destination), studyID, type, fileID))
+                    if not keep:
+                        os.remove(file_path)
+                    converted += 1
+                except Exception as e:
+                    logger.error(f'An error has occured while converting the file {file_path} of the study with ID {studyID}: {e}.')
+                    failed += 1
+    
+    logger.info(f'{converted} layers converted to {target}, {failed} failed.')
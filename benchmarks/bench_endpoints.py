@@ -0,0 +1,182 @@
+import io
+import os
+import sys
+import json
+import time
+import sqlite3
+import tempfile
+import subprocess
+import argparse
+import statistics
+import tracemalloc
+
+
+
+#####
+# Benchmark of the endpoints on synthetic studies and subdivisions, by size tier
+# Each tier runs in a new process with its own data: a study with its outline, a subdivision, and other studies in the database.
+# Reports for each endpoint the latency of the first and next requests, the peak memory and the payload size,
+# the results can be saved and compared with the ones of another version
+# Usage: python benchmarks/bench_endpoints.py --tiers small,medium --output results.json [--compare previous.json]
+#####
+
+tiers = {
+    'small': {'zones': 1000, 'vertices': 8, 'studies': 100},
+    'medium': {'zones': 10000, 'vertices': 16, 'studies': 1000},
+    'large': {'zones': 50000, 'vertices': 32, 'studies': 10000},
+}
+
+# Command line
+parser = argparse.ArgumentParser()
+parser.add_argument('--tiers', default='small,medium')
+parser.add_argument('--runs', type=int, default=5) # next requests of each endpoint
+parser.add_argument('--multipolygons', type=float, default=0.1) # share of the zones
+parser.add_argument('--unclean', type=float, default=0.02) # share of the zones
+parser.add_argument('--output', default=None)
+parser.add_argument('--compare', default=None)
+parser.add_argument('--tier-run', default=None) # run of a tier in its process
+args = parser.parse_args()
+
+app_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+
+# Peak memory of the workers of the jobs in MB, from /proc on linux
+def workers_peak_memory(app):
+    peaks = []
+    for process in list(getattr(app.jobs_pool, '_processes', {}).values()):
+        try:
+            with open(f'/proc/{process.pid}/status') as status:
+                peaks += [int(line.split()[1]) / 1024 for line in status if line.startswith('VmHWM')]
+        except OSError:
+            pass
+    return max(peaks) if len(peaks) > 0 else None
+
+
+# Run the tier in this process and print its results
+def run_tier(name):
+    import logging
+    import synthetic
+    os.chdir(tempfile.mkdtemp())
+    sys.path.insert(0, app_path)
+    import app
+    logging.disable(logging.CRITICAL)
+    client = app.app.test_client()
+    tier = tiers[name]
+    results = {}
+
+    # Wait for a job and give its result
+    def wait(response):
+        while True:
+            job = client.get(f'/jobs/{response["jobID"]}').get_json()['job']
+            if job['state'] not in ['queued', 'running']:
+                return job
+            time.sleep(0.01)
+
+    # A job, its memory is the peak of the workers started for it
+    def measure_job(endpoint, request):
+        if app.jobs_pool is not None:
+            app.jobs_pool.shutdown()
+            app.jobs_pool = None
+        start = time.perf_counter()
+        response = request()
+        job = wait(response.get_json())
+        latency = time.perf_counter() - start
+        results[endpoint] = {'first ms': latency * 1000, 'next ms': None, 'peak MB': workers_peak_memory(app), 'payload bytes': len(response.data)}
+        if job['state'] != 'success':
+            raise Exception(f'The job of {endpoint} failed: {job["message"]}')
+        return job['result']
+
+    # A request, then the next ones, and the memory of the request without the caches of the app
+    def measure(endpoint, request):
+        start = time.perf_counter()
+        response = request()
+        first = time.perf_counter() - start
+        if response.get_json()['status'] != 'success':
+            raise Exception(f'The request of {endpoint} failed: {response.get_json()}')
+        latencies = []
+        for _ in range(args.runs):
+            start = time.perf_counter()
+            request()
+            latencies.append(time.perf_counter() - start)
+        app.rendered_maps.clear()
+        app.spatial_indexes.clear()
+        tracemalloc.start()
+        request()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        results[endpoint] = {'first ms': first * 1000, 'next ms': statistics.median(latencies) * 1000, 'peak MB': peak / 1024**2, 'payload bytes': len(response.data)}
+        return response.get_json()
+
+    # Study
+    outline = synthetic.outline_zip()
+    studyID = measure_job('studies_manager_create', lambda: client.post('/studies_manager/create', data={
+        'studyName': 'Benchmark', 'studyDesc': name, 'studyLat': '45.5', 'studyLon': '-73.72',
+        'studyOutline': (outline, 'outline.zip')
+    }))['id']
+
+    # Other studies, they are loaded with the next request
+    con = sqlite3.connect(os.path.join('data', 'studies.db'))
+    con.executemany(
+        'INSERT INTO studies (name, desc, lat, lon, dir_path, visibility) VALUES (?, ?, ?, ?, ?, ?)',
+        [(f'Study {i}', 'Synthetic', 40 + (i % 97) / 10, -80 + (i % 89) / 10, os.path.join('data', f'{i} - Study {i}'), False) for i in range(tier['studies'])]
+    )
+    con.commit()
+    con.close()
+
+    # Subdivision
+    subdiv = synthetic.subdiv_zip(zones=tier['zones'], vertices=tier['vertices'], multipolygons=args.multipolygons, unclean=args.unclean).getvalue()
+    token = measure('subdiv_preprocess', lambda: client.post(f'/study/{studyID}/add_file/subdiv/preprocess', data={
+        'fileFile': (io.BytesIO(subdiv), 'zones.zip')
+    }))['fileToken']
+    fileID = measure_job('subdiv_process', lambda: client.post(f'/study/{studyID}/add_file/subdiv/process', data={
+        'fileToken': token, 'fileName': 'zones', 'fileHeaders': json.dumps(synthetic.headers)
+    }))['fileID']
+
+    # Maps
+    measure('studies_manager', lambda: client.get('/studies_manager'))
+    measure('study_map', lambda: client.get(f'/study/{studyID}/map'))
+    measure('study_subdiv', lambda: client.post(f'/study/{studyID}/subdiv/{fileID}', data=json.dumps({'first_map': True})))
+    measure('study_subdiv zoom 14', lambda: client.post(f'/study/{studyID}/subdiv/{fileID}', data=json.dumps({
+        'first_map': False, 'center': {'lat': 45.5, 'lng': -73.72}, 'zoom': 14, 'selected': '1'
+    })))
+
+    print(json.dumps(results))
+
+
+# Table of the results, with the ratios to the compared results
+def report(results, compared):
+    for name, tier in results.items():
+        print(f'{name} ({", ".join(f"{key} {value}" for key, value in tiers[name].items())})')
+        for endpoint, measures in tier.items():
+            line = f'  {endpoint:22}'
+            for key, value in measures.items():
+                line += f'  {key} ' + ('-' if value is None else f'{value:.0f}' if value >= 10 else f'{value:.2f}')
+                previous = compared.get(name, {}).get(endpoint, {}).get(key)
+                if value is not None and previous:
+                    line += f' (x{value / previous:.2f})'
+            print(line)
+
+
+if args.tier_run is not None:
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    if __name__ == '__main__':
+        run_tier(args.tier_run)
+
+elif __name__ == '__main__':
+    # Benchmark, each tier in its process
+    results = {}
+    for name in args.tiers.split(','):
+        command = [sys.executable, os.path.abspath(__file__), '--tier-run', name, '--runs', str(args.runs), '--multipolygons', str(args.multipolygons), '--unclean', str(args.unclean)]
+        output = subprocess.run(command, capture_output=True, text=True, check=True).stdout
+        results[name] = json.loads(output.strip().splitlines()[-1])
+
+    compared = {}
+    if args.compare is not None:
+        with open(args.compare) as file:
+            compared = json.load(file)['results']
+    report(results, compared)
+
+    if args.output is not None:
+        version = subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=app_path, capture_output=True, text=True).stdout.strip()
+        with open(args.output, 'w') as file:
+            json.dump({'version': version, 'multipolygons': args.multipolygons, 'unclean': args.unclean, 'results': results}, file, indent=2)
@@ -0,0 +1,62 @@
+import os
+import sys
+import time
+import argparse
+
+
+
+#####
+# Benchmark of the simplification levels of the ingestion
+# For a synthetic subdivision that forms a coverage (zones with shared borders) and one that does not, reports for
+# each level the vertices and GeoJSON size, the time to simplify, the change of the shapes of the zones, and for the
+# coverage the share of its area lost to gaps and covered by overlaps, with the simplification geometry by geometry
+# and as a coverage
+# Usage: python benchmarks/bench_levels.py --zones 10000 --vertices 32
+#####
+
+# Command line
+parser = argparse.ArgumentParser()
+parser.add_argument('--zones', type=int, default=10000)
+parser.add_argument('--vertices', type=int, default=32) # by border of a zone of the coverage, by zone otherwise
+args = parser.parse_args()
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import shapely
+import synthetic
+import ingestion
+
+
+# Area of the union of the geometries, and the area covered by more than one of them, in squared degrees
+def coverage_areas(geometry):
+    union = shapely.union_all(geometry.values).area
+    return union, float(shapely.area(geometry.values).sum()) - union
+
+
+# Area of the difference between the simplified and the original geometries, as a share of their area
+def shape_error(geometry, original):
+    return float(shapely.area(shapely.symmetric_difference(geometry.values, original.values)).sum() / shapely.area(original.values).sum())
+
+
+# Benchmark, the zones of the other subdivision are apart from each other
+for name, data in [
+    ('coverage', synthetic.coverage_data(zones=args.zones, vertices=args.vertices)),
+    ('zones', synthetic.subdiv_data(zones=args.zones, vertices=args.vertices))
+]:
+    ingestion.reproject(data)
+    coverage = ingestion.is_coverage(data.geometry.values)
+    area = coverage_areas(data.geometry)[0]
+    full = ingestion.level_report(data.geometry)
+    print(f'{name} ({len(data)} zones, valid coverage {coverage})  full  vertices {full["vertices"]}  bytes {full["bytes"]}')
+    for level in ingestion.simplification_zooms:
+        tolerance = 360 / (256 * 2**level) / 2
+        for method in ['geometry', 'coverage'] if coverage else ['geometry']:
+            start = time.perf_counter()
+            geometry = ingestion.simplify_geometries(data.geometry, tolerance, method == 'coverage')
+            duration = time.perf_counter() - start
+            report = ingestion.level_report(geometry)
+            line = f'  zoom_{level:<3} {method:9} vertices {report["vertices"]:>9}  bytes {report["bytes"]:>10}  {duration * 1000:6.0f} ms  shape error {shape_error(geometry, data.geometry):.2%}'
+            if coverage:
+                union, overlap = coverage_areas(geometry)
+                line += f'  gaps {max(area - union, 0) / area:.2%}  overlaps {max(overlap, 0) / area:.2%}'
+            print(line)
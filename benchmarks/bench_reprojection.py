@@ -0,0 +1,66 @@
+import os
+import sys
+import time
+import argparse
+import statistics
+
+
+
+#####
+# Scaling benchmark of the reprojection of the ingestion
+# Reprojects a synthetic subdivision in a projected crs to EPSG:4326 with to_crs, then with the chunked reprojection
+# of the ingestion for each number of threads, a single one included so that the scaling is measured on the same
+# path, and checks that the geometries are the same
+# Usage: python benchmarks/bench_reprojection.py --zones 50000 --vertices 64 --threads 1,2,4,8 --runs 3
+#####
+
+# Command line
+parser = argparse.ArgumentParser()
+parser.add_argument('--zones', type=int, default=50000)
+parser.add_argument('--vertices', type=int, default=64)
+parser.add_argument('--threads', default=None) # numbers of threads, up to the number of cores by default
+parser.add_argument('--runs', type=int, default=3)
+args = parser.parse_args()
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import shapely
+import synthetic
+import ingestion
+
+cores = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+if args.threads is not None:
+    threads = [int(count) for count in args.threads.split(',')]
+else:
+    threads = sorted({1, cores} | {2**i for i in range(1, cores.bit_length()) if 2**i < cores})
+
+
+# Median duration of a reprojection of copies of the data, and the last result
+def measure(data, function):
+    durations = []
+    for _ in range(args.runs):
+        copy = data.copy()
+        start = time.perf_counter()
+        function(copy)
+        durations.append(time.perf_counter() - start)
+    return statistics.median(durations), copy
+
+
+# Benchmark
+data = synthetic.subdiv_data(zones=args.zones, vertices=args.vertices)
+print(f'{args.zones} zones, {shapely.get_num_coordinates(data.geometry.values).sum()} vertices, {cores} cores')
+baseline, expected = measure(data, lambda copy: copy.to_crs(epsg=4326, inplace=True))
+print(f'to_crs      {baseline * 1000:.0f} ms')
+
+ingestion.reprojection_min_vertices = 0
+single = None
+for count in threads:
+    ingestion.reprojection_threads = count
+    if ingestion.reprojection_pool is not None:
+        ingestion.reprojection_pool.shutdown()
+        ingestion.reprojection_pool = None
+    ingestion.reproject(data.copy()) # pool and transformers
+    duration, result = measure(data, ingestion.reproject)
+    single = single or duration
+    same = shapely.equals_exact(expected.geometry.values, result.geometry.values, tolerance=0).all()
+    print(f'{count:2} threads  {duration * 1000:.0f} ms  speedup x{baseline / duration:.2f} (x{single / duration:.2f} of 1 thread)  same geometries {same}')
@@ -0,0 +1,112 @@
+import os
+import sys
+import time
+import sqlite3
+import random
+import tempfile
+import threading
+import argparse
+
+
+
+#####
+# Concurrency benchmark of the studies database
+# Compares a new connection for each statement (the former behaviour) to the connections kept by each thread
+# Usage: python benchmarks/bench_sqlite.py --threads 8 --operations 500 --writes 0.2
+#####
+
+# Command line
+parser = argparse.ArgumentParser()
+parser.add_argument('--threads', type=int, default=8)
+parser.add_argument('--operations', type=int, default=500) # by thread
+parser.add_argument('--writes', type=float, default=0.2) # share of the operations that are writes
+parser.add_argument('--studies', type=int, default=1000)
+args = parser.parse_args()
+
+# The app is set up in a temporary folder
+app_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+os.chdir(tempfile.mkdtemp())
+sys.path.insert(0, app_path)
+import logging
+logging.disable(logging.CRITICAL)
+import app
+
+
+# Fill the studies database
+def fill(db_path):
+    con = sqlite3.connect(db_path)
+    con.executescript(app.db_schemas['studies.db'])
+    con.executemany(
+        'INSERT INTO studies (name, desc, lat, lon, dir_path, visibility) VALUES (?, ?, ?, ?, ?, ?)',
+        [(f'Study {i}', 'Description', 45.5, -73.5, f'data/{i} - Study {i}', False) for i in range(args.studies)]
+    )
+    con.commit()
+    con.close()
+
+
+# Former behaviour: a connection for each statement, and a commit for each write
+def operation_per_request(db_path, write, studyID):
+    con = sqlite3.connect(db_path)
+    cursor = con.cursor()
+    if write:
+        cursor.execute(f'UPDATE studies SET visibility = ? WHERE id = {studyID}', (random.random() < 0.5,))
+        con.commit()
+    else:
+        cursor.execute(f'SELECT * FROM studies WHERE id = {studyID}').fetchone()
+    con.close()
+
+
+# Connection of the thread
+def operation_pooled(db_path, write, studyID):
+    con = app.get_connection(db_path)
+    if write:
+        con.execute('UPDATE studies SET visibility = ? WHERE id = ?', (random.random() < 0.5, studyID))
+    else:
+        con.execute('SELECT * FROM studies WHERE id = ?', (studyID,)).fetchone()
+
+
+# Run the operations in the threads and give the throughput, the latencies and the errors
+def run(operation, db_path):
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+
+    def worker():
+        thread_latencies = []
+        thread_errors = 0
+        for _ in range(args.operations):
+            write = random.random() < args.writes
+            studyID = random.randint(1, args.studies)
+            start = time.perf_counter()
+            try:
+                operation(db_path, write, studyID)
+            except sqlite3.OperationalError:
+                thread_errors += 1
+            thread_latencies.append(time.perf_counter() - start)
+        with lock:
+            latencies.extend(thread_latencies)
+            errors.append(thread_errors)
+
+    threads = [threading.Thread(target=worker) for _ in range(args.threads)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    duration = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        'operations/s': len(latencies) / duration,
+        'p50 ms': latencies[len(latencies) // 2] * 1000,
+        'p95 ms': latencies[int(len(latencies) * 0.95)] * 1000,
+        'errors': sum(errors)
+    }
+
+
+# Benchmark
+for name, operation in [('per request', operation_per_request), ('pooled', operation_pooled)]:
+    db_path = os.path.join(tempfile.mkdtemp(), 'studies.db')
+    fill(db_path)
+    result = run(operation, db_path)
+    print(f'{name:12} ' + '  '.join(f'{key} {value:.2f}' if isinstance(value, float) else f'{key} {value}' for key, value in result.items()))
@@ -0,0 +1,93 @@
+import os
+import sys
+import json
+import sqlite3
+import tempfile
+import subprocess
+import argparse
+import statistics
+
+
+
+#####
+# Cold start benchmark of the app
+# Measures in new processes the import of the app and the time to the first response of endpoints,
+# the app of another folder (another version of this repository) can be measured on the same data
+# Usage: python benchmarks/bench_startup.py --studies 10000 --runs 5 [--app path/to/other/version] [--warm-up 2]
+#####
+
+# Command line
+parser = argparse.ArgumentParser()
+parser.add_argument('--studies', type=int, default=10000)
+parser.add_argument('--runs', type=int, default=5)
+parser.add_argument('--app', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+parser.add_argument('--warm-up', type=float, default=None) # seconds between the start of the warm up and the first request
+args = parser.parse_args()
+
+endpoints = ['/study/1', '/studies_manager', '/study/1/map']
+
+
+# Studies database, with the outline of the first study
+def fill(data_path):
+    import geopandas as gpd
+    import shapely
+    os.makedirs(os.path.join(data_path, '1 - Study 1'))
+    gpd.GeoDataFrame(geometry=[shapely.box(-73.6, 45.4, -73.4, 45.6)], crs=4326).to_file(os.path.join(data_path, '1 - Study 1', 'outline.gpkg'), driver='GPKG')
+    con = sqlite3.connect(os.path.join(data_path, 'studies.db'))
+    con.execute('CREATE TABLE studies (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT, desc TEXT, lat FLOAT, lon FLOAT, dir_path TEXT, visibility BOOL)')
+    con.executemany(
+        'INSERT INTO studies (name, desc, lat, lon, dir_path, visibility) VALUES (?, ?, ?, ?, ?, ?)',
+        [(f'Study {i}', 'Description', 45.5 + (i % 100) / 100, -73.5 + (i // 100 % 100) / 100, os.path.join('data', f'{i} - Study {i}'), False) for i in range(1, args.studies + 1)]
+    )
+    con.commit()
+    con.close()
+
+
+# Process measuring the import of the app, then the first and second responses of an endpoint
+child = '''
+import sys, time, json, logging
+app_path, endpoint, warm_up = sys.argv[1], sys.argv[2], sys.argv[3]
+sys.path.insert(0, app_path)
+start = time.perf_counter()
+import app
+imported = time.perf_counter() - start
+logging.disable(logging.CRITICAL)
+if warm_up != 'None':
+    time.sleep(float(warm_up))
+client = app.app.test_client()
+start = time.perf_counter()
+status = client.get(endpoint).get_json()['status']
+first = time.perf_counter() - start
+start = time.perf_counter()
+client.get(endpoint)
+second = time.perf_counter() - start
+print(json.dumps({'import': imported, 'first': first, 'second': second, 'status': status}))
+'''
+
+
+# Run the measures in a folder with the data
+def measure(endpoint, work_path):
+    env = dict(os.environ)
+    env.pop('DASHBOARD_WARM_UP', None)
+    if args.warm_up is not None:
+        env['DASHBOARD_WARM_UP'] = '1'
+    results = []
+    for _ in range(args.runs):
+        output = subprocess.run([sys.executable, '-c', child, os.path.abspath(args.app), endpoint, str(args.warm_up)], cwd=work_path, env=env, capture_output=True, text=True, check=True).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+    return results
+
+
+# Benchmark
+work_path = tempfile.mkdtemp()
+fill(os.path.join(work_path, 'data'))
+measure(endpoints[0], work_path) # migrations of the database
+for endpoint in endpoints:
+    results = measure(endpoint, work_path)
+    print(
+        f'{endpoint:18} '
+        f'import {statistics.median(result["import"] for result in results) * 1000:.0f} ms  '
+        f'first response {statistics.median(result["first"] for result in results) * 1000:.0f} ms  '
+        f'second response {statistics.median(result["second"] for result in results) * 1000:.0f} ms  '
+        f'status {results[0]["status"]}'
+    )
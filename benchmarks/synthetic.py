@@ -0,0 +1,117 @@
+import io
+import os
+import math
+import shutil
+import zipfile
+import tempfile
+import numpy as np
+import shapely
+import geopandas as gpd
+
+
+
+#####
+# Synthetic data for the benchmarks
+# Outlines and subdivisions as zipped shapefiles, like the ones uploaded to the app
+#####
+
+# Columns of the synthetic subdivisions, as given by the user when processing a file
+headers = {'Geometry': 'geometry', 'Subzone ID': 'ZONE_ID', 'Subzone name': 'ZONE_NAME'}
+
+
+# Zipfile of a geo dataframe as a shapefile
+def shapefile_zip(data, name='zones'):
+    folder = tempfile.mkdtemp()
+    try:
+        data.to_file(os.path.join(folder, f'{name}.shp'))
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+            for file in sorted(os.listdir(folder)):
+                zip_file.write(os.path.join(folder, file), file)
+    finally:
+        shutil.rmtree(folder)
+    buffer.seek(0)
+    return buffer
+
+
+# Subdivision of a square area (in meters of the crs) in zones, each one a polygon with a number of vertices
+# around the center of its cell. A share of the zones are multipolygons with an islet in the corner of their cell,
+# and a share have an id that is not an integer, they are then unclean in the app.
+def subdiv_data(zones=1000, vertices=16, multipolygons=0.1, unclean=0.02, size=20000, center=(600000, 5040000), crs=32618, seed=0):
+    rng = np.random.default_rng(seed)
+    side = math.ceil(math.sqrt(zones))
+    cell = size / side
+    rows, cols = np.divmod(np.arange(zones), side)
+    x = center[0] - size / 2 + (cols + 0.5) * cell
+    y = center[1] - size / 2 + (rows + 0.5) * cell
+
+    # Polygons with random radii around the centers
+    angles = np.linspace(0, 2 * math.pi, vertices, endpoint=False)
+    radii = cell / 2 * rng.uniform(0.7, 0.95, (zones, vertices))
+    rings = np.stack([x[:, None] + radii * np.cos(angles), y[:, None] + radii * np.sin(angles)], axis=-1)
+    geometries = shapely.polygons(rings)
+
+    # Multipolygons
+    multi = np.flatnonzero(rng.random(zones) < multipolygons)
+    islets = shapely.box(x[multi] + 0.42 * cell, y[multi] + 0.42 * cell, x[multi] + 0.48 * cell, y[multi] + 0.48 * cell)
+    geometries[multi] = [shapely.MultiPolygon([polygon, islet]) for polygon, islet in zip(geometries[multi], islets)]
+
+    # Ids, the unclean ones are not integers
+    ids = np.arange(1, zones + 1, dtype=float)
+    ids[rng.random(zones) < unclean] += 0.5
+
+    return gpd.GeoDataFrame({
+        'ZONE_ID': ids,
+        'ZONE_NAME': [f'Zone {i}' for i in range(1, zones + 1)],
+        'POP': rng.integers(0, 5000, zones)
+    }, geometry=geometries, crs=crs)
+
+
+# Subdivision of a square area (in meters of the crs) in a grid of zones that form a coverage, like census blocks:
+# their borders are shared lines with a number of vertices, wavy and with some noise, except on the outer border
+def coverage_data(zones=1000, vertices=64, size=20000, center=(600000, 5040000), crs=32618, seed=0):
+    rng = np.random.default_rng(seed)
+    side = math.ceil(math.sqrt(zones))
+    cell = size / side
+    steps = np.linspace(0, size, side * vertices + 1)
+    
+    # Lines between the zones, straight on the outer border
+    lines = []
+    for i in range(side + 1):
+        offset = np.zeros(len(steps))
+        if 0 < i < side:
+            offset = 0.15 * cell * np.sin(steps / cell * 2 + i) + rng.normal(0, 0.01 * cell, len(steps))
+            offset[[0, -1]] = 0
+        lines.append(np.column_stack([i * cell + offset, steps]))
+        lines.append(np.column_stack([steps, i * cell + offset]))
+    noded = shapely.union_all(shapely.linestrings(lines))
+    geometries = shapely.get_parts(shapely.polygonize(shapely.get_parts(noded)))
+    geometries = shapely.transform(geometries, lambda coords: coords + [center[0] - size / 2, center[1] - size / 2])
+    
+    count = len(geometries)
+    return gpd.GeoDataFrame({
+        'ZONE_ID': np.arange(1, count + 1, dtype=float),
+        'ZONE_NAME': [f'Zone {i}' for i in range(1, count + 1)],
+        'POP': rng.integers(0, 5000, count)
+    }, geometry=geometries, crs=crs)
+
+
+# Outline of the same area as a subdivision, a polygon with a number of vertices
+def outline_data(vertices=256, size=20000, center=(600000, 5040000), crs=32618):
+    angles = np.linspace(0, 2 * math.pi, vertices, endpoint=False)
+    radius = size / math.sqrt(2)
+    ring = np.stack([center[0] + radius * np.cos(angles), center[1] + radius * np.sin(angles)], axis=-1)
+    return gpd.GeoDataFrame({'NAME': ['Outline']}, geometry=[shapely.Polygon(ring)], crs=crs)
+
+
+# Zipped shapefiles of a subdivision, of a coverage and of an outline
+def subdiv_zip(**kwargs):
+    return shapefile_zip(subdiv_data(**kwargs), 'zones')
+
+
+def coverage_zip(**kwargs):
+    return shapefile_zip(coverage_data(**kwargs), 'zones')
+
+
+def outline_zip(**kwargs):
+    return shapefile_zip(outline_data(**kwargs), 'outline')
@@ -0,0 +1,654 @@
+import os
+import io
+import json
+import time
+import shutil
+import zipfile
+import threading
+import importlib.util
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+
+
+#####
+# Set up
+#####
+
+# Module imported when one of its attributes is first used, so that the heavy modules are only imported when needed
+class LazyModule:
+    def __init__(self, name):
+        self.name = name
+        self.module = None
+    
+    def load(self):
+        if self.module is None:
+            self.module = importlib.import_module(self.name)
+        return self.module
+    
+    def __getattr__(self, attr):
+        return getattr(self.load(), attr)
+
+
+np = LazyModule('numpy')
+shapely = LazyModule('shapely')
+gpd = LazyModule('geopandas')
+pyproj = LazyModule('pyproj')
+pyogrio = LazyModule('pyogrio')
+pq = LazyModule('pyarrow.parquet')
+pc = LazyModule('pyarrow.compute')
+fcntl = LazyModule('fcntl') # not on windows, the slots of the jobs are then not shared by the processes
+
+# Global variables
+simplification_zooms = [6, 9, 12] # highest zoom of each simplification level, full resolution above
+coverage_tolerance_factor = 2 # the tolerance of a coverage is the square root of the area of the triangles removed, not a distance
+storage_extensions = {'gpkg': '.gpkg', 'parquet': '.parquet'} # extension of the files of each storage format
+parquet_row_group_size = 4096 # features, the row groups outside of a bounding box are skipped when reading
+parquet_crs = {} # CRS of the GeoParquet files by their PROJJSON, they are slow to build
+reprojection_threads = int(os.environ.get('DASHBOARD_REPROJECTION_THREADS') or 0) or os.cpu_count() or 1 # the workers of the jobs get their share of the cores
+reprojection_min_vertices = 200000 # the smaller layers are reprojected by a single thread
+reprojection_pool = None # started with the first reprojection in threads
+reprojection_transformers = {} # transformers to EPSG:4326 by thread and CRS, a transformer cannot be shared by threads
+
+# Progress of the jobs, sent by the worker processes to the app
+job_progress = None
+
+
+
+#####
+# Data processing
+#####
+
+# Clean the ids and names of a subdivision. When it is read in batches, the sorted ids of the previous batches are
+# given in seen_ids['ids'] and the ids of the batch are added to them.
+def clean_subdiv(data_subdiv, seen_ids=None):
+    # Integer ids, the conversion goes through str like the user input would
+    float_ids = data_subdiv['old_zone_id'].astype(str).astype(float)
+    int_ids = (float_ids % 1 == 0)
+    data_subdiv['zone_id'] = float_ids.where(int_ids, -1).astype('int64')
+    
+    # String names
+    str_names = data_subdiv['old_zone_name'].map(type).eq(str)
+    data_subdiv['zone_name'] = data_subdiv['old_zone_name'].where(str_names, '')
+    
+    # Clean flag
+    data_subdiv['clean'] = int_ids & str_names
+    
+    # Check for unique ids
+    clean_ids = data_subdiv.loc[int_ids, 'zone_id']
+    if seen_ids is not None:
+        ids = np.sort(clean_ids.to_numpy())
+        positions = np.searchsorted(seen_ids['ids'], ids)
+        seen = seen_ids['ids'][np.minimum(positions, len(seen_ids['ids']) - 1)] == ids if len(seen_ids['ids']) > 0 else np.zeros(len(ids), dtype=bool)
+        if (ids[1:] == ids[:-1]).any() or seen.any():
+            raise Exception('The file does not contain unique ids.')
+        seen_ids['ids'] = np.insert(seen_ids['ids'], positions, ids)
+    elif len(clean_ids) == 0:
+        raise Exception('There are no id that are integers.')
+    elif clean_ids.duplicated().any():
+        raise Exception('The file does not contain unique ids.')
+    
+    # Keep the good columns
+    return data_subdiv[['clean', 'geometry', 'zone_id', 'zone_name']]
+
+
+# Transformer of the thread from a CRS to EPSG:4326, they are kept since they are slow to build
+def wgs84_transformer(crs):
+    key = (threading.get_ident(), crs)
+    if key not in reprojection_transformers:
+        reprojection_transformers[key] = pyproj.Transformer.from_crs(crs, 4326, always_xy=True)
+    return reprojection_transformers[key]
+
+
+# Reproject a geo dataframe to EPSG:4326. The vertices of the big layers are split in a chunk by thread and transformed
+# by a pool of threads, pyproj releases the GIL while transforming, a single chunk is transformed in this thread.
+# The layers with z coordinates use to_crs.
+def reproject(data):
+    global reprojection_pool
+    geometries = data.geometry.values
+    if data.crs is None or geometries.has_z.any() or shapely.get_num_coordinates(geometries).sum() < reprojection_min_vertices:
+        data.to_crs(epsg=4326, inplace=True)
+        return data
+    crs = data.crs
+    if crs.is_exact_same(pyproj.CRS.from_epsg(4326)):
+        return data
+    
+    # Transform the coordinates in place by chunks
+    coordinates = shapely.get_coordinates(geometries)
+    x = np.ascontiguousarray(coordinates[:, 0])
+    y = np.ascontiguousarray(coordinates[:, 1])
+    chunk = -(-len(x) // reprojection_threads)
+    def transform(start):
+        wgs84_transformer(crs).transform(x[start:start + chunk], y[start:start + chunk], inplace=True)
+    if reprojection_threads == 1:
+        transform(0)
+    else:
+        if reprojection_pool is None:
+            reprojection_pool = ThreadPoolExecutor(max_workers=reprojection_threads)
+        list(reprojection_pool.map(transform, range(0, len(x), chunk)))
+    
+    data[data.geometry.name] = gpd.GeoSeries(shapely.set_coordinates(np.array(geometries, dtype=object), np.column_stack([x, y])), index=data.index, crs=4326)
+    return data
+
+
+# Find the single shapefile within a zipfile, without extracting it
+def open_shapefile_zip(source):
+    zip_file = zipfile.ZipFile(source, 'r')
+    files = [f for f in zip_file.namelist() if not f.endswith('/') and not f.startswith('__MACOSX/')]
+    
+    # Get the different files
+    shp_files = [f for f in files if f.endswith('.shp')]
+    shx_files = [f for f in files if f.endswith('.shx')]
+    dbf_files = [f for f in files if f.endswith('.dbf')]
+    
+    # Check if the zipfile as a single shapefile and the mandatory files
+    count = len(shp_files) + len(shx_files) + len(dbf_files)
+    nb_mandatory_files = 3 # shp, shx and dbf
+    if count > nb_mandatory_files:
+        raise Exception('There are multiple shapefiles within the zipfile.')
+    elif count < nb_mandatory_files:
+        raise Exception('The shapefile is incomplete.')
+    
+    # Members of the shapefile, with the optional projection and encoding
+    base = os.path.splitext(shp_files[0])[0]
+    members = {'shp': shp_files[0], 'shx': shx_files[0], 'dbf': dbf_files[0]}
+    for ext in ['prj', 'cpg']:
+        members[ext] = base + '.' + ext if base + '.' + ext in files else None
+    
+    return {'source': source, 'zip': zip_file, 'members': members}
+
+
+# Read a shapefile found by open_shapefile_zip
+def read_shapefile_zip(shapefile_zip):
+    members = shapefile_zip['members']
+    
+    # A shapefile at the root of the zipfile is read as is
+    if '/' not in members['shp']:
+        source = shapefile_zip['source']
+        if hasattr(source, 'seek'):
+            source.seek(0)
+        return gpd.read_file(source)
+    
+    # Otherwise its members are put at the root of an uncompressed zipfile in memory
+    buffer = io.BytesIO()
+    write_shapefile_zip(shapefile_zip, buffer)
+    buffer.seek(0)
+    return gpd.read_file(buffer)
+
+
+# Find all the shapefiles within a zipfile, by the path of their shp file
+def open_shapefiles_zip(source):
+    zip_file = zipfile.ZipFile(source, 'r')
+    files = [f for f in zip_file.namelist() if not f.endswith('/') and not f.startswith('__MACOSX/')]
+    
+    shapefiles = {}
+    for shp_file in sorted(f for f in files if f.endswith('.shp')):
+        # Mandatory files
+        base = os.path.splitext(shp_file)[0]
+        members = {'shp': shp_file}
+        for ext in ['shx', 'dbf']:
+            if base + '.' + ext not in files:
+                raise Exception(f'The shapefile {shp_file} is incomplete.')
+            members[ext] = base + '.' + ext
+        
+        # Optional projection and encoding
+        for ext in ['prj', 'cpg']:
+            members[ext] = base + '.' + ext if base + '.' + ext in files else None
+        shapefiles[shp_file] = {'source': source, 'zip': zip_file, 'members': members}
+    
+    if len(shapefiles) == 0:
+        raise Exception('There is no shapefile within the zipfile.')
+    return shapefiles
+
+
+# Size of the members of a shapefile found by open_shapefile_zip once extracted
+def shapefile_size(shapefile_zip):
+    return sum(shapefile_zip['zip'].getinfo(member).file_size for member in shapefile_zip['members'].values() if member is not None)
+
+
+# Extract the members of a shapefile found by open_shapefile_zip to a folder, so that its features can be read
+# in batches without decompressing it again for each one, and give the path of its shp file
+def extract_shapefile_zip(shapefile_zip, folder):
+    os.makedirs(folder, exist_ok=True)
+    for member in shapefile_zip['members'].values():
+        if member is not None:
+            with shapefile_zip['zip'].open(member) as source, open(os.path.join(folder, os.path.basename(member)), 'wb') as destination:
+                shutil.copyfileobj(source, destination, 1024**2)
+    return os.path.join(folder, os.path.basename(shapefile_zip['members']['shp']))
+
+
+# Write the members of a shapefile at the root of an uncompressed zipfile
+def write_shapefile_zip(shapefile_zip, destination):
+    with zipfile.ZipFile(destination, 'w', zipfile.ZIP_STORED) as flat_zip:
+        for member in shapefile_zip['members'].values():
+            if member is not None:
+                flat_zip.writestr(os.path.basename(member), shapefile_zip['zip'].read(member))
+
+
+# Read the schema of a shapefile found by open_shapefile_zip with GDAL, without the geometries, so that the columns
+# and their encoding are the ones read_file gives. A zipfile on disk is read in place, a shapefile within a folder of
+# a zipfile in memory is put at the root of another zipfile first.
+def read_shapefile_schema(shapefile_zip):
+    source = shapefile_zip['source']
+    shp_file = shapefile_zip['members']['shp']
+    if isinstance(source, (str, os.PathLike)):
+        info = pyogrio.read_info(f'/vsizip/{os.path.abspath(source)}/{shp_file}')
+    elif '/' not in shp_file:
+        source.seek(0)
+        info = pyogrio.read_info(source)
+    else:
+        buffer = io.BytesIO()
+        write_shapefile_zip(shapefile_zip, buffer)
+        info = pyogrio.read_info(buffer.getvalue())
+    
+    columns = [str(column) for column in info['fields']]
+    types = {}
+    for column, ogr_type, ogr_subtype in zip(columns, info['ogr_types'], info['ogr_subtypes']):
+        if ogr_subtype == 'OFSTBoolean':
+            types[column] = 'bool'
+        else:
+            types[column] = {'OFTInteger': 'int', 'OFTInteger64': 'int', 'OFTReal': 'float', 'OFTDate': 'date', 'OFTDateTime': 'date'}.get(ogr_type, 'str')
+    columns.append('geometry')
+    types['geometry'] = 'geometry'
+    
+    return {'columns': columns, 'types': types, 'count': int(info['features']), 'crs': info['crs']}
+
+
+# Simplification level displayed at a zoom, None for the full resolution
+def simplification_level(zoom):
+    for level in simplification_zooms:
+        if zoom <= level:
+            return level
+    return None
+
+
+# Check if the geometries of a layer form a coverage: valid polygons that do not overlap and whose shared borders
+# have the same vertices, like the zones of a subdivision usually do. Zones apart from each other share no border,
+# they are not a coverage.
+def is_coverage(geometries):
+    try:
+        return bool(
+            np.isin(shapely.get_type_id(geometries), [3, 6]).all() # polygons and multipolygons
+            and shapely.is_valid(geometries).all()
+            and shapely.coverage_is_valid(geometries)
+            and shapely.STRtree(geometries).query(geometries, predicate='touches').shape[1] > 0
+        )
+    except Exception:
+        return False
+
+
+# Simplify the geometries of a layer. A coverage is simplified as a whole so that the borders of its zones stay shared,
+# without gaps or overlaps between them, and the other layers geometry by geometry. The outer border of a coverage that is
+# a batch of a layer is kept, since it is shared with the zones of the other batches.
+def simplify_geometries(geometry, tolerance, coverage, batch=None):
+    if not coverage:
+        return geometry.simplify(tolerance, preserve_topology=True)
+    values = np.array(geometry.values, dtype=object)
+    present = ~(shapely.is_missing(values) | shapely.is_empty(values))
+    values[present] = shapely.coverage_simplify(values[present], tolerance * coverage_tolerance_factor, simplify_boundary=batch is None)
+    return gpd.GeoSeries(values, index=geometry.index, crs=geometry.crs)
+
+
+# Number of vertices and GeoJSON size of the geometries of a simplification level
+def level_report(geometry):
+    return {
+        'vertices': int(geometry.count_coordinates().sum()),
+        'bytes': sum(len(geojson) for geojson in shapely.to_geojson(geometry.values) if geojson is not None)
+    }
+
+
+# Save the simplification levels of a saved layer, or of a batch of it, and give their number of vertices and GeoJSON size
+def save_simplified_levels(data, file_path, batch=None):
+    values = np.asarray(data.geometry.values, dtype=object)
+    coverage = is_coverage(values[~(shapely.is_missing(values) | shapely.is_empty(values))])
+    report = {'full': level_report(data.geometry)}
+    simplified = {}
+    for level in simplification_zooms:
+        tolerance = 360 / (256 * 2**level) / 2 # half a pixel at the equator
+        simplified[level] = simplify_geometries(data.geometry, tolerance, coverage, batch)
+        report[f'zoom_{level}'] = level_report(simplified[level])
+    save_levels(data, simplified, file_path, batch)
+    return report
+
+
+# Metadata of a file for the catalog
+def file_metadata(data, file_path):
+    minx, miny, maxx, maxy = [float(value) for value in data.total_bounds] if len(data) > 0 else [None]*4
+    nb_clean = int(data['clean'].sum()) if 'clean' in data.columns else len(data)
+    return {
+        'features': len(data),
+        'clean': nb_clean,
+        'unclean': len(data) - nb_clean,
+        'minx': minx,
+        'miny': miny,
+        'maxx': maxx,
+        'maxy': maxy,
+        'crs': data.crs.to_string() if data.crs is not None else None,
+        'vertices': int(data.geometry.count_coordinates().sum()),
+        'size': os.path.getsize(file_path)
+    }
+
+
+
+#####
+# Storage
+#####
+
+# The layers are stored as geopackages with a layer for each simplification level, or as GeoParquet files when their
+# extension is .parquet, with a geometry column for each simplification level and the bounding box of each feature.
+
+# Whether a file is stored as GeoParquet
+def is_parquet(file_path):
+    return file_path.endswith(storage_extensions['parquet'])
+
+
+# Geometry column of a simplification level in a GeoParquet file
+def level_column(level):
+    return 'geometry' if level is None else f'geometry_zoom_{level}'
+
+
+# CRS of a geometry column of a GeoParquet file, built once for each PROJJSON
+def geometry_crs(column):
+    projjson = column.get('crs', 'OGC:CRS84') # longitudes and latitudes when it is not given
+    key = json.dumps(projjson, sort_keys=True)
+    if key not in parquet_crs:
+        parquet_crs[key] = pyproj.CRS.from_user_input(projjson)
+    return parquet_crs[key]
+
+
+# Save a layer at full resolution. A layer saved in batches, numbered from 0, is a geopackage the next batches are
+# appended to, with multi geometries so that the type of the layer fits the geometries of every batch.
+def save_layer(data, file_path, batch=None, layer=None):
+    if is_parquet(file_path):
+        if batch is not None:
+            raise Exception('A GeoParquet file cannot be saved in batches.')
+        data.to_parquet(file_path, write_covering_bbox=True, row_group_size=parquet_row_group_size)
+    elif batch is None:
+        data.to_file(file_path, driver='GPKG', layer=layer)
+    else:
+        data.to_file(file_path, driver='GPKG', layer=layer, mode='w' if batch == 0 else 'a', promote_to_multi=True)
+
+
+# Save the simplification levels of a saved layer, or of a batch of it, given as geometries by level. They are added
+# as columns to a GeoParquet file, which is written again, and as layers to a geopackage.
+def save_levels(data, levels, file_path, batch=None):
+    if is_parquet(file_path):
+        save_layer(data.assign(**{level_column(level): geometry.values for level, geometry in levels.items()}), file_path, batch)
+    else:
+        for level, geometry in levels.items():
+            save_layer(data.set_geometry(geometry), file_path, batch, layer=f'zoom_{level}')
+
+
+# Simplification levels stored in a file
+def stored_levels(file_path):
+    if is_parquet(file_path):
+        columns = json.loads(pq.read_schema(file_path).metadata[b'geo'])['columns']
+        return [level for level in simplification_zooms if level_column(level) in columns]
+    layers = gpd.list_layers(file_path)['name'].tolist()
+    return [level for level in simplification_zooms if f'zoom_{level}' in layers]
+
+
+# Read a layer at a simplification level, with only the features within the bounding box (minx, miny, maxx, maxy)
+# if one is given and only the columns given, with the geometry, if some are. A GeoParquet file is memory mapped,
+# and its other geometry columns are not read.
+def read_layer(file_path, level=None, bbox=None, columns=None):
+    if not is_parquet(file_path):
+        return gpd.read_file(file_path, layer=0 if level is None else f'zoom_{level}', bbox=bbox, columns=columns)
+    
+    # Columns of the file
+    parquet_file = pq.ParquetFile(file_path, memory_map=True)
+    geo = json.loads(parquet_file.schema_arrow.metadata[b'geo'])
+    geometry = level_column(level)
+    if geometry not in geo['columns']:
+        raise Exception(f'There is no simplification level {level} in the file.')
+    if columns is None:
+        columns = [name for name in parquet_file.schema_arrow.names if name not in geo['columns'] and name != 'bbox' and not name.startswith('__')]
+    
+    # Features within the bounding box, from the bounding boxes of the full resolution
+    filters = None
+    if bbox is not None:
+        covering = geo['columns']['geometry']['covering']['bbox']
+        minx, miny, maxx, maxy = bbox
+        filters = (
+            (pc.field(*covering['xmin']) <= maxx) & (pc.field(*covering['xmax']) >= minx)
+            & (pc.field(*covering['ymin']) <= maxy) & (pc.field(*covering['ymax']) >= miny)
+        )
+    
+    table = pq.read_table(file_path, columns=list(columns) + [geometry], filters=filters, memory_map=True)
+    crs = geometry_crs(geo['columns'][geometry])
+    geometries = gpd.GeoSeries.from_wkb(table.column(geometry).to_numpy(zero_copy_only=False), crs=crs)
+    return gpd.GeoDataFrame(table.drop_columns([geometry]).to_pandas(), geometry=geometries.values, crs=crs)
+
+
+# Convert a stored layer, with its simplification levels, to the format of the destination
+def convert_layer(source, destination):
+    data = read_layer(source)
+    levels = {level: read_layer(source, level).geometry for level in stored_levels(source)}
+    if os.path.exists(destination):
+        os.remove(destination)
+    if not is_parquet(destination): # a GeoParquet file is written at once with its levels
+        save_layer(data, destination)
+    save_levels(data, levels, destination)
+
+
+
+#####
+# Jobs
+#####
+
+# Set up of a worker process of the jobs, with its threads of reprojection unless they are set by the environment
+def init_worker(progress_queue, threads=None):
+    global job_progress, reprojection_threads
+    job_progress = progress_queue
+    if threads is not None and not os.environ.get('DASHBOARD_REPROJECTION_THREADS'):
+        reprojection_threads = threads
+
+
+# Hold a slot of the jobs while a task runs, so that the processes of the app run at most job['slots']['count']
+# tasks together. A slot is a lock on a file, released by the system if its worker dies.
+@contextmanager
+def job_slot(job):
+    if job.get('slots') is None or importlib.util.find_spec('fcntl') is None:
+        yield
+        return
+    os.makedirs(job['slots']['dir'], exist_ok=True)
+    while True:
+        for i in range(job['slots']['count']):
+            slot = open(os.path.join(job['slots']['dir'], f'slot_{i}.lock'), 'a')
+            try:
+                fcntl.flock(slot, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                slot.close()
+                continue
+            try:
+                yield
+            finally:
+                fcntl.flock(slot, fcntl.LOCK_UN)
+                slot.close()
+            return
+        if os.path.exists(job['cancel']):
+            raise Exception('The job was cancelled.')
+        time.sleep(0.1)
+
+
+# Run a task of a job in a worker once it holds a slot
+def run_task(function, job, *args):
+    with job_slot(job):
+        return function(job, *args)
+
+
+# Tell the app the stage of a task of a job and its progress (between 0 and 1), and stop the job if it was cancelled
+def report(job, stage, progress):
+    if job_progress is not None:
+        job_progress.put((job['id'], job['task'], stage, progress))
+    if os.path.exists(job['cancel']):
+        raise Exception('The job was cancelled.')
+
+
+# Read a shapefile found by open_shapefile_zip in batches of features, the shapefile is extracted next to the file.
+# Each batch is reprojected, prepared by prepare(data, last), then saved with its simplification levels, so that
+# only a batch is in memory. Gives the timings, the simplification levels and the metadata of the file.
+def ingest_batches(job, shapefile_zip, file_path, batch_size, prepare, columns=None):
+    timings = {'read': 0, 'clean': 0, 'save': 0, 'simplify': 0}
+    levels = {}
+    metadata = []
+    count = read_shapefile_schema(shapefile_zip)['count']
+    folder = file_path + '.shapefile'
+    try:
+        report(job, 'read', 0)
+        start = time.perf_counter()
+        shp_path = extract_shapefile_zip(shapefile_zip, folder)
+        timings['read'] += time.perf_counter() - start
+        
+        offsets = range(0, max(count, 1), batch_size)
+        for batch, offset in enumerate(offsets):
+            progress = batch / len(offsets)
+            
+            # Read and reproject the batch
+            report(job, 'read', progress)
+            start = time.perf_counter()
+            data = gpd.read_file(shp_path, rows=slice(offset, offset + batch_size), columns=columns)
+            reproject(data)
+            timings['read'] += time.perf_counter() - start
+            
+            # Prepare it
+            report(job, 'clean', progress)
+            start = time.perf_counter()
+            data = prepare(data, batch == len(offsets) - 1)
+            timings['clean'] += time.perf_counter() - start
+            
+            # Save it
+            report(job, 'save', progress)
+            start = time.perf_counter()
+            save_layer(data, file_path, batch)
+            metadata.append(file_metadata(data, file_path))
+            timings['save'] += time.perf_counter() - start
+            
+            # Save its simplification levels
+            report(job, 'simplify', progress)
+            start = time.perf_counter()
+            for level, level_report in save_simplified_levels(data, file_path, batch).items():
+                levels.setdefault(level, {'vertices': 0, 'bytes': 0})
+                levels[level]['vertices'] += level_report['vertices']
+                levels[level]['bytes'] += level_report['bytes']
+            timings['simplify'] += time.perf_counter() - start
+    
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+    
+    # Metadata of the whole file
+    bounds = [batch_metadata for batch_metadata in metadata if batch_metadata['minx'] is not None]
+    return {'timings': timings, 'levels': levels, 'metadata': {
+        'features': sum(batch_metadata['features'] for batch_metadata in metadata),
+        'clean': sum(batch_metadata['clean'] for batch_metadata in metadata),
+        'unclean': sum(batch_metadata['unclean'] for batch_metadata in metadata),
+        'minx': min((batch_metadata['minx'] for batch_metadata in bounds), default=None),
+        'miny': min((batch_metadata['miny'] for batch_metadata in bounds), default=None),
+        'maxx': max((batch_metadata['maxx'] for batch_metadata in bounds), default=None),
+        'maxy': max((batch_metadata['maxy'] for batch_metadata in bounds), default=None),
+        'crs': metadata[0]['crs'],
+        'vertices': sum(batch_metadata['vertices'] for batch_metadata in metadata),
+        'size': os.path.getsize(file_path)
+    }}
+
+
+# Read, reproject and save the outline of a study, in batches of features if a batch size is given
+def ingest_outline(job, source, file_path, batch_size=None):
+    timings = {}
+    
+    # Read the file in batches
+    if batch_size is not None:
+        shapefile_zip = open_shapefile_zip(source)
+        try:
+            result = ingest_batches(job, shapefile_zip, file_path, batch_size, lambda data, last: data.rename(columns={'fid': 'old_fid'}))
+        finally:
+            shapefile_zip['zip'].close()
+        return {'timings': result['timings'], 'levels': result['levels']}
+    
+    # Read the shapefile within the zipfile
+    report(job, 'read', 0)
+    start = time.perf_counter()
+    shapefile_zip = open_shapefile_zip(source)
+    data_outline = read_shapefile_zip(shapefile_zip)
+    shapefile_zip['zip'].close()
+    reproject(data_outline)
+    data_outline.rename(columns={'fid': 'old_fid'}, inplace=True) # avoid conflict with geopackage
+    timings['read'] = time.perf_counter() - start
+    
+    # Save the geo dataframe and its simplification levels
+    report(job, 'save', 0.5)
+    start = time.perf_counter()
+    save_layer(data_outline, file_path)
+    levels = save_simplified_levels(data_outline, file_path)
+    timings['save'] = time.perf_counter() - start
+    
+    return {'timings': timings, 'levels': levels}
+
+
+# Keep the columns of the geometry, the ids and the names of a subdivision given by the headers, and rename them
+def select_subdiv_columns(data_subdiv, headers):
+    data_subdiv = data_subdiv[[
+        str(headers['Geometry']),
+        str(headers['Subzone ID']),
+        str(headers['Subzone name'])
+    ]]
+    return data_subdiv.rename(columns={
+        str(headers['Geometry']): 'geometry',
+        str(headers['Subzone ID']): 'old_zone_id',
+        str(headers['Subzone name']): 'old_zone_name'
+    })
+
+
+# Read, reproject, clean and save a subdivision, the headers give the columns of the geometry, the ids and the names.
+# A big subdivision is read in batches of features if a batch size is given, the ids are unique across the batches.
+def ingest_subdiv(job, source, headers, file_path, batch_size=None):
+    timings = {}
+    
+    # Read the file in batches
+    if batch_size is not None:
+        seen_ids = {'ids': np.empty(0, dtype='int64')}
+        def prepare(data_subdiv, last):
+            data_subdiv = clean_subdiv(select_subdiv_columns(data_subdiv, headers), seen_ids)
+            if last and len(seen_ids['ids']) == 0:
+                raise Exception('There are no id that are integers.')
+            return data_subdiv
+        
+        shapefile_zip = open_shapefile_zip(source)
+        try:
+            result = ingest_batches(job, shapefile_zip, file_path, batch_size, prepare, columns=[str(headers['Subzone ID']), str(headers['Subzone name'])])
+        finally:
+            shapefile_zip['zip'].close()
+        return {'count': result['metadata']['features'], 'timings': result['timings'], 'levels': result['levels'], 'metadata': result['metadata']}
+    
+    # Read the file
+    report(job, 'read', 0)
+    start = time.perf_counter()
+    shapefile_zip = open_shapefile_zip(source)
+    data_subdiv = read_shapefile_zip(shapefile_zip)
+    shapefile_zip['zip'].close()
+    reproject(data_subdiv)
+    
+    # Keep the good columns
+    data_subdiv = select_subdiv_columns(data_subdiv, headers)
+    
+    timings['read'] = time.perf_counter() - start
+    
+    # Clean the dataset
+    report(job, 'clean', 0.4)
+    start = time.perf_counter()
+    data_subdiv = clean_subdiv(data_subdiv)
+    timings['clean'] = time.perf_counter() - start
+    
+    # Save the geo dataframe
+    report(job, 'save', 0.5)
+    start = time.perf_counter()
+    save_layer(data_subdiv, file_path)
+    timings['save'] = time.perf_counter() - start
+    
+    # Save the simplification levels
+    report(job, 'simplify', 0.7)
+    start = time.perf_counter()
+    levels = save_simplified_levels(data_subdiv, file_path)
+    timings['simplify'] = time.perf_counter() - start
+    
+    return {'count': len(data_subdiv), 'timings': timings, 'levels': levels, 'metadata': file_metadata(data_subdiv, file_path)}